@@ -0,0 +1,168 @@
+# -*- encoding=utf8 -*-
+"""Bulk IPv4 address helpers on integer-packed arrays.
+
+The addresses are packed into array('I') of host-order integers, so an
+inventory of tens of thousands of nodes is validated, deduplicated and
+matched against subnets with integer operations instead of string work.
+NumPy is used for the subnet operations when it is installed.
+"""
+
+import array
+import socket
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# 元素为32位无符号整数的array类型码
+TYPECODE = 'I' if array.array('I').itemsize == 4 else 'L'
+_UINT32 = struct.Struct('!I')
+FULL_MASK = 0xffffffff
+
+
+def ip_to_int(ip):
+    """'10.0.0.1' => 167772161, None is returned if ip is invalid.
+
+    Only the dotted-decimal form with four parts is accepted, surrounding
+    spaces included are not.
+    """
+
+    try:
+        return _UINT32.unpack(socket.inet_pton(socket.AF_INET, ip))[0]
+    except (socket.error, AttributeError, TypeError, ValueError):
+        return None
+
+
+def is_valid_ip(ip):
+    """Return True if ip is an IPv4 or IPv6 address, as it is."""
+
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, ip)
+            return True
+        except (socket.error, TypeError, ValueError):
+            pass
+    return False
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(_UINT32.pack(value))
+
+
+def pack(ips):
+    """Pack the addresses into an array('I').
+
+    Returns:
+        (packed, invalid), invalid is the list of the addresses that can
+        not be parsed, they are not packed.
+    """
+
+    packed = array.array(TYPECODE)
+    invalid = []
+    for ip in ips:
+        value = ip_to_int(ip)
+        if value is None:
+            invalid.append(ip)
+        else:
+            packed.append(value)
+    return packed, invalid
+
+
+def unpack(packed):
+    return [int_to_ip(value) for value in packed]
+
+
+def dedupe(packed):
+    """Remove the duplicated addresses, the first occurrences are kept in
+    order.
+    """
+
+    seen = set()
+    result = array.array(TYPECODE)
+    for value in packed:
+        if value not in seen:
+            seen.add(value)
+            result.append(value)
+    return result
+
+
+def parse_groups(text, group_sep='#', sep=','):
+    """Parse a string like ip1,ip2#ip3,ip4 into one packed array per group.
+
+    Returns:
+        A list of array('I'), None if the string is empty or any address is
+        invalid.
+    """
+
+    groups = []
+    for part in text.split(group_sep):
+        packed, invalid = pack(part.split(sep))
+        if invalid:
+            return None
+        groups.append(packed)
+    if len(groups) == 0:
+        return None
+    return groups
+
+
+def prefix_to_mask(prefix):
+    """18 => 0xffffc000"""
+
+    if prefix < 0 or prefix > 32:
+        raise Exception("Invalid prefix length:%s" % prefix)
+    return (FULL_MASK << (32 - prefix)) & FULL_MASK
+
+
+def mask_to_prefix(mask, strict=False):
+    """'255.255.192.0' (or its integer) => 18
+
+    Args:
+        strict: If True, a mask whose bits are not contiguous raises an
+            Exception, otherwise the set bits are counted.
+    """
+
+    value = mask if isinstance(mask, (int, long)) else ip_to_int(mask)
+    if value is None:
+        raise Exception("Invalid mask:%s" % mask)
+    # 逐个清除最低的置1位来计数
+    prefix = 0
+    bits = value
+    while bits:
+        bits &= bits - 1
+        prefix += 1
+    if strict and prefix_to_mask(prefix) != value:
+        raise Exception("Mask %s is not contiguous" % mask)
+    return prefix
+
+
+def network(ip, prefix):
+    """Return the network address (an integer) of ip in a subnet."""
+
+    value = ip if isinstance(ip, (int, long)) else ip_to_int(ip)
+    if value is None:
+        raise Exception("Invalid ip:%s" % ip)
+    return value & prefix_to_mask(prefix)
+
+
+def in_subnet(packed, subnet_ip, prefix):
+    """Return a list of bools telling which addresses of packed are in the
+    subnet subnet_ip/prefix.
+    """
+
+    mask = prefix_to_mask(prefix)
+    net = network(subnet_ip, prefix)
+    if numpy is not None and packed.itemsize == 4 and len(packed) > 0:
+        values = numpy.frombuffer(packed, dtype=numpy.uint32)
+        return ((values & numpy.uint32(mask)) == numpy.uint32(net)).tolist()
+    return [(value & mask) == net for value in packed]
+
+
+def select_subnet(packed, subnet_ip, prefix):
+    """Return the array of the addresses of packed in the subnet."""
+
+    return array.array(TYPECODE, [value for value, hit in
+                                  zip(packed, in_subnet(packed, subnet_ip,
+                                                        prefix)) if hit])
@@ -0,0 +1,247 @@
+# -*- encoding=utf8 -*-
+"""A process-wide registry of timing metrics.
+
+Every timed call is recorded as a span: the spans of the same name are
+aggregated into a Timer (count, total, min, max and a histogram for the
+percentiles), and the spans started inside another span form a tree. The
+registry can be exported as JSON or in the Prometheus text format, so the
+slow steps can be compared across runs.
+"""
+
+import cProfile
+import contextlib
+import json
+import pstats
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2没有tracemalloc，不支持内存统计
+    tracemalloc = None
+
+
+# 直方图的桶上界（秒）：从1ms开始每个桶增大sqrt(2)倍，最大约9小时
+BUCKETS = [0.001 * 2 ** (i / 2.0) for i in range(50)]
+QUANTILES = (0.5, 0.95, 0.99)
+# 保留的最近的根span数量
+MAX_ROOT_SPANS = 1000
+
+
+class Timer(object):
+    """The aggregated durations of the spans of one name."""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.memory_peak = None
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def observe(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def observe_memory(self, peak):
+        if self.memory_peak is None or peak > self.memory_peak:
+            self.memory_peak = peak
+
+    def percentile(self, q):
+        """Estimate the q (0 to 1) percentile from the histogram, the upper
+        bound of the bucket is returned, clamped to [min, max].
+        """
+
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n > 0:
+                bound = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(max(bound, self.min), self.max)
+        return self.max
+
+    def to_dict(self):
+        result = {
+            'name': self.name,
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+        }
+        for q in QUANTILES:
+            result['p%d' % int(q * 100)] = self.percentile(q)
+        if self.memory_peak is not None:
+            result['memory_peak'] = self.memory_peak
+        return result
+
+
+class Span(object):
+    """One timed call, with the spans started inside it as children."""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.children = []
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'start': self.start,
+            'duration': self.duration,
+            'children': [child.to_dict() for child in self.children],
+        }
+
+
+class Registry(object):
+    """Timers, span trees and profiles of the timed functions."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.roots = []
+        self.profiles = {}
+        self.local = threading.local()
+
+    def timer(self, name):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = Timer(name)
+            return timer
+
+    @contextlib.contextmanager
+    def span(self, name, profile=False, trace_memory=False):
+        """Time the block as a span of name.
+
+        Args:
+            profile: If True, the block runs under cProfile and the stats are
+                accumulated in profiles[name]. Only one profiler can be
+                active in a thread, so a profiled span nested in another
+                one is included in the outer profile and has none of its
+                own.
+            trace_memory: If True and tracemalloc is available, the peak
+                memory allocated by the block is recorded.
+        """
+
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        span = Span(name)
+        stack.append(span)
+        profiler = None
+        if profile and not getattr(self.local, 'profiling', False):
+            profiler = cProfile.Profile()
+            self.local.profiling = True
+        tracing = trace_memory and tracemalloc is not None
+        if tracing:
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        start = time.time()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield span
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                self.local.profiling = False
+            span.duration = time.time() - start
+            stack.pop()
+            timer = self.timer(name)
+            with self.lock:
+                timer.observe(span.duration)
+                if tracing:
+                    timer.observe_memory(tracemalloc.get_traced_memory()[1])
+                if stack:
+                    stack[-1].children.append(span)
+                else:
+                    self.roots.append(span)
+                    del self.roots[:-MAX_ROOT_SPANS]
+                if profiler is not None:
+                    if name in self.profiles:
+                        self.profiles[name].add(profiler)
+                    else:
+                        self.profiles[name] = pstats.Stats(profiler)
+            if tracing and started_tracing:
+                tracemalloc.stop()
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.roots = []
+            self.profiles = {}
+
+    def to_json(self):
+        with self.lock:
+            return json.dumps({
+                'timers': [self.timers[name].to_dict()
+                           for name in sorted(self.timers)],
+                'spans': [span.to_dict() for span in self.roots],
+            }, indent=2)
+
+    def to_prometheus(self, metric='function_duration_seconds'):
+        """Export the timers as Prometheus summaries."""
+
+        lines = ['# TYPE %s summary' % metric]
+        with self.lock:
+            for name in sorted(self.timers):
+                timer = self.timers[name]
+                label = 'name="%s"' % name.replace('\\', '\\\\') \
+                    .replace('"', '\\"')
+                for q in QUANTILES:
+                    value = timer.percentile(q)
+                    lines.append('%s{%s,quantile="%s"} %s' % (
+                        metric, label, q, 'NaN' if value is None else
+                        repr(value)))
+                lines.append('%s_sum{%s} %r' % (metric, label, timer.total))
+                lines.append('%s_count{%s} %d' % (metric, label, timer.count))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path, fmt='json'):
+        """Write the registry to path, fmt is 'json' or 'prometheus'."""
+
+        if fmt == 'json':
+            content = self.to_json()
+        elif fmt == 'prometheus':
+            content = self.to_prometheus()
+        else:
+            raise Exception("Unknown metrics format:%s" % fmt)
+        with open(path, 'w') as f:
+            f.write(content)
+
+    def dump_profile(self, name, path):
+        """Write the accumulated cProfile stats of name to path."""
+
+        with self.lock:
+            stats = self.profiles.get(name)
+            if stats is None:
+                raise Exception("No profile of %s" % name)
+            stats.dump_stats(path)
+
+
+_registry = Registry()
+
+
+def get_registry():
+    """Return the process-wide Registry."""
+
+    return _registry
@@ -0,0 +1,132 @@
+# -*- encoding=utf8 -*-
+"""Read the mount table from /proc/self/mountinfo.
+
+The mount table is parsed in-process into MountEntry records indexed by
+file system type and mount point, instead of running mount and parsing its
+output. MountWatcher tells when the mount table changes.
+"""
+
+import collections
+import errno
+import re
+import select
+
+
+MOUNTINFO_PATH = '/proc/self/mountinfo'
+
+# mountinfo中一行的各字段，参见proc(5)
+MountEntry = collections.namedtuple(
+    'MountEntry',
+    ['mount_id', 'parent_id', 'device', 'root', 'mount_point', 'options',
+     'fstype', 'source', 'super_options'])
+
+_ESCAPE_PATTERN = re.compile(r'\\([0-7]{3})')
+
+
+def _unescape(field):
+    """mountinfo escapes space, tab, newline and backslash as \\ooo."""
+
+    return _ESCAPE_PATTERN.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+
+def parse_mountinfo(text):
+    """Parse the content of a mountinfo file.
+
+    Returns:
+        A list of MountEntry, in the order of the mounts.
+    """
+
+    entries = []
+    for line in text.splitlines():
+        fields = line.split()
+        # 可选字段的个数不定，以单独的"-"结束
+        try:
+            sep = fields.index('-', 6)
+        except ValueError:
+            continue
+        if len(fields) < sep + 3:
+            continue
+        entries.append(MountEntry(
+            int(fields[0]), int(fields[1]), fields[2], _unescape(fields[3]),
+            _unescape(fields[4]), fields[5], fields[sep + 1],
+            _unescape(fields[sep + 2]),
+            fields[sep + 3] if len(fields) > sep + 3 else ''))
+    return entries
+
+
+class MountTable(object):
+    """The mount entries, indexed by file system type and mount point."""
+
+    def __init__(self, entries):
+        self.entries = entries
+        self.by_fstype = collections.defaultdict(list)
+        self.by_mount_point = {}
+        for entry in entries:
+            self.by_fstype[entry.fstype].append(entry)
+            # 同一挂载点被重复挂载时，后挂载的可见
+            self.by_mount_point[entry.mount_point] = entry
+
+    @classmethod
+    def load(cls, path=MOUNTINFO_PATH):
+        """Read and parse the mount table, IOError is raised if failed."""
+
+        with open(path, 'r') as f:
+            return cls(parse_mountinfo(f.read()))
+
+    def of_type(self, fstype):
+        """Return the entries of a file system type."""
+
+        return list(self.by_fstype.get(fstype, []))
+
+    def mount_points(self, fstype):
+        return [entry.mount_point for entry in self.of_type(fstype)]
+
+    def get(self, mount_point):
+        """Return the entry mounted on mount_point, or None."""
+
+        return self.by_mount_point.get(mount_point)
+
+    def format(self):
+        """Format the table like the output of the mount command."""
+
+        return '\n'.join("%s on %s type %s (%s)" % (
+            entry.source, entry.mount_point, entry.fstype, entry.options)
+            for entry in self.entries)
+
+
+class MountWatcher(object):
+    """Wait for the changes of the mount table.
+
+    The kernel reports POLLPRI|POLLERR on an opened mountinfo file when a
+    file system is mounted or unmounted, the file must be read again to be
+    notified of the next change.
+    """
+
+    def __init__(self, path=MOUNTINFO_PATH):
+        self.file = open(path, 'r')
+        self.file.read()
+        self.poller = select.poll()
+        self.poller.register(self.file.fileno(), select.POLLPRI |
+                             select.POLLERR)
+
+    def wait(self, timeout=None):
+        """Wait for at most timeout seconds (None means forever).
+
+        Returns:
+            The new MountTable if the mount table changed, otherwise None.
+        """
+
+        try:
+            events = self.poller.poll(None if timeout is None else
+                                      int(timeout * 1000))
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return None
+        if not events:
+            return None
+        self.file.seek(0)
+        return MountTable(parse_mountinfo(self.file.read()))
+
+    def close(self):
+        self.file.close()
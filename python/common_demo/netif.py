@@ -0,0 +1,224 @@
+# -*- encoding=utf8 -*-
+"""Read the addresses of the local network interfaces in-process.
+
+The addresses are dumped through a rtnetlink socket instead of parsing the
+output of ifconfig or ip addr. The result is cached, and a second netlink
+socket subscribed to the address and link change notifications tells when
+the cache must be refreshed.
+"""
+
+import collections
+import errno
+import socket
+import struct
+import threading
+
+
+NETLINK_ROUTE = 0
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+RTM_NEWADDR = 20
+RTM_GETADDR = 22
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+IFLA_IFNAME = 3
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_LABEL = 3
+
+NLMSGHDR = struct.Struct('=IHHII')
+IFINFOMSG = struct.Struct('=BxHiII')
+IFADDRMSG = struct.Struct('=BBBBI')
+RTATTR = struct.Struct('=HH')
+
+# 一个接口地址的信息：
+# iface: 接口名；label: 地址的标签（别名地址形如eth0:1）；family: 4或6；
+# prefixlen: 前缀长度；virtual: 是否为ifconfig看不到的附加地址
+InterfaceAddress = collections.namedtuple(
+    'InterfaceAddress',
+    ['iface', 'label', 'family', 'address', 'prefixlen', 'virtual'])
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _parse_attrs(data, offset):
+    """Parse the rtattrs from offset to the end of data into a dict."""
+
+    attrs = {}
+    while offset + RTATTR.size <= len(data):
+        length, attr_type = RTATTR.unpack_from(data, offset)
+        if length < RTATTR.size:
+            break
+        attrs[attr_type] = data[offset + RTATTR.size:offset + length]
+        offset += _align(length)
+    return attrs
+
+
+def _dump(msg_type, payload):
+    """Send a netlink dump request and return the (type, body) of all the
+    messages of the reply.
+    """
+
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, 0))
+        seq = 1
+        sock.send(NLMSGHDR.pack(NLMSGHDR.size + len(payload), msg_type,
+                                NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + payload)
+        messages = []
+        while True:
+            data = sock.recv(65536)
+            offset = 0
+            while offset + NLMSGHDR.size <= len(data):
+                length, nl_type, _, nl_seq, _ = NLMSGHDR.unpack_from(data,
+                                                                     offset)
+                if length < NLMSGHDR.size:
+                    break
+                body = data[offset + NLMSGHDR.size:offset + length]
+                offset += _align(length)
+                if nl_seq != seq:
+                    continue
+                if nl_type == NLMSG_DONE:
+                    return messages
+                if nl_type == NLMSG_ERROR:
+                    err = -struct.unpack_from('=i', body)[0]
+                    raise socket.error(err, "netlink dump failed")
+                messages.append((nl_type, body))
+    finally:
+        sock.close()
+
+
+def _read_iface_names():
+    names = {}
+    for nl_type, body in _dump(RTM_GETLINK, IFINFOMSG.pack(0, 0, 0, 0, 0)):
+        if nl_type != RTM_NEWLINK:
+            continue
+        _, _, index, _, _ = IFINFOMSG.unpack_from(body)
+        attrs = _parse_attrs(body, IFINFOMSG.size)
+        if IFLA_IFNAME in attrs:
+            names[index] = attrs[IFLA_IFNAME].rstrip('\0')
+    return names
+
+
+def read_addresses():
+    """Dump the addresses of all the local interfaces.
+
+    Returns:
+        A list of InterfaceAddress, in the order of the interfaces.
+    """
+
+    names = _read_iface_names()
+    addresses = []
+    seen_labels = set()
+    for nl_type, body in _dump(RTM_GETADDR, IFADDRMSG.pack(0, 0, 0, 0, 0)):
+        if nl_type != RTM_NEWADDR:
+            continue
+        family, prefixlen, _, _, index = IFADDRMSG.unpack_from(body)
+        attrs = _parse_attrs(body, IFADDRMSG.size)
+        iface = names.get(index, str(index))
+        if family == socket.AF_INET:
+            # 点对点接口的IFA_ADDRESS是对端地址，本端地址在IFA_LOCAL中
+            raw = attrs.get(IFA_LOCAL, attrs.get(IFA_ADDRESS))
+            if raw is None:
+                continue
+            label = attrs.get(IFA_LABEL, iface).rstrip('\0')
+            # ifconfig每个标签只显示一个地址，同一标签的其他地址即虚拟IP
+            virtual = label in seen_labels
+            seen_labels.add(label)
+            addresses.append(InterfaceAddress(
+                iface, label, 4, socket.inet_ntop(socket.AF_INET, raw),
+                prefixlen, virtual))
+        elif family == socket.AF_INET6:
+            raw = attrs.get(IFA_ADDRESS)
+            if raw is None:
+                continue
+            addresses.append(InterfaceAddress(
+                iface, iface, 6, socket.inet_ntop(socket.AF_INET6, raw),
+                prefixlen, False))
+    return addresses
+
+
+class Inventory(object):
+    """The cached addresses of the local interfaces.
+
+    A netlink socket subscribed to the address and link notifications is
+    checked before each read, the addresses are dumped again only if it
+    received something since the last dump.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.addresses = None
+        self.monitor = None
+
+    def get(self):
+        with self.lock:
+            if self.addresses is None or self._changed():
+                self._open_monitor()
+                self.addresses = read_addresses()
+            return list(self.addresses)
+
+    def invalidate(self):
+        with self.lock:
+            self.addresses = None
+
+    def _open_monitor(self):
+        if self.monitor is not None:
+            return
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                                 NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR |
+                       RTMGRP_IPV6_IFADDR))
+            sock.setblocking(0)
+        except socket.error:
+            # 无法订阅时每次都重新读取
+            return
+        self.monitor = sock
+
+    def _changed(self):
+        if self.monitor is None:
+            return True
+        changed = False
+        while True:
+            try:
+                if not self.monitor.recv(65536):
+                    break
+                changed = True
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                # ENOBUFS等错误说明通知有丢失
+                return True
+        return changed
+
+
+_inventory = Inventory()
+
+
+def get_addresses(family=None, include_virtual=True):
+    """Return the InterfaceAddress of the local interfaces.
+
+    Args:
+        family: 4 or 6 to return only the IPv4 or IPv6 addresses, None for
+            both.
+        include_virtual: If False, the addresses that ifconfig does not
+            show (secondary addresses without their own label) are excluded.
+    """
+
+    return [a for a in _inventory.get()
+            if (family is None or a.family == family)
+            and (include_virtual or not a.virtual)]
+
+
+def invalidate():
+    """Force the next get_addresses to read the addresses again."""
+
+    _inventory.invalidate()
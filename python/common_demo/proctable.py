@@ -0,0 +1,180 @@
+# -*- encoding=utf8 -*-
+"""Look up processes by scanning /proc in-process.
+
+ProcessTable keeps a snapshot of the processes. A refresh lists /proc and
+reads the stat of each process, the cmdline is only read again for the
+processes that are new or whose stat changed, so repeated lookups on a
+node with many processes are cheap. Many names can be looked up in a
+single scan.
+"""
+
+import collections
+import os
+import re
+import threading
+import time
+
+
+PROC_PATH = '/proc'
+
+# cmdline中的参数以空格连接，与ps -ef显示的一致
+ProcessInfo = collections.namedtuple('ProcessInfo', ['pid', 'comm', 'cmdline'])
+
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except (IOError, OSError):
+        # 进程已经退出
+        return None
+
+
+def read_stat(pid):
+    """Return the (comm, start time) of pid from /proc/<pid>/stat, or None
+    if the process has exited. A reused pid has a different start time, and
+    an exec changes the comm of a process (unless the new program has the
+    same name).
+    """
+
+    stat = _read('%s/%d/stat' % (PROC_PATH, pid))
+    if stat is None:
+        return None
+    # comm在括号中，可能包含空格和括号，以最后一个")"为界
+    end = stat.rfind(')')
+    comm = stat[stat.find('(') + 1:end]
+    # ")"之后从第3个字段开始，启动时间是第22个字段
+    fields = stat[end + 2:].split()
+    return comm, int(fields[19])
+
+
+def read_process(pid, stat=None):
+    """Return the ProcessInfo of pid, or None if the process has exited.
+
+    Args:
+        stat: The read_stat of pid if it has already been read.
+    """
+
+    if stat is None:
+        stat = read_stat(pid)
+    cmdline = _read('%s/%d/cmdline' % (PROC_PATH, pid))
+    if stat is None or cmdline is None:
+        return None
+    comm = stat[0]
+    cmdline = cmdline.rstrip('\0').replace('\0', ' ')
+    if cmdline == '':
+        # 内核线程没有cmdline，ps显示为[comm]
+        cmdline = '[%s]' % comm
+    return ProcessInfo(pid, comm, cmdline)
+
+
+def list_pids():
+    return set(int(name) for name in os.listdir(PROC_PATH) if name.isdigit())
+
+
+class ProcessTable(object):
+    """A snapshot of the processes, refreshed incrementally.
+
+    A refresh drops the processes that have exited, and reads the processes
+    that are new, whose pid was reused (the start time changed) or that
+    exec'ed another program (the comm changed). An exec of a program of the
+    same name is not noticed, refresh(full=True) reads every process again.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.processes = {}
+        # pid -> read_stat的结果
+        self.stats = {}
+        self.refreshed = 0
+
+    def refresh(self, full=False):
+        with self.lock:
+            pids = list_pids()
+            for pid in list(self.processes):
+                if pid not in pids:
+                    del self.processes[pid]
+                    del self.stats[pid]
+            for pid in pids:
+                stat = read_stat(pid)
+                if stat is None:
+                    self.processes.pop(pid, None)
+                    self.stats.pop(pid, None)
+                    continue
+                if full or self.stats.get(pid) != stat:
+                    info = read_process(pid, stat)
+                    if info is None:
+                        self.processes.pop(pid, None)
+                        self.stats.pop(pid, None)
+                        continue
+                    self.processes[pid] = info
+                    self.stats[pid] = stat
+            self.refreshed = time.time()
+
+    def snapshot(self, max_age=0, full=False):
+        """Return the processes sorted by pid, the table is refreshed if it
+        is older than max_age seconds (always if full, see refresh).
+        """
+
+        if full or time.time() - self.refreshed >= max_age:
+            self.refresh(full)
+        with self.lock:
+            return [self.processes[pid] for pid in sorted(self.processes)]
+
+    def find(self, name, exact=False, regex=False, max_age=0, full=False):
+        """Return the sorted pids of the processes that match name.
+
+        Args:
+            name: The name to be matched.
+            exact: If True, name must equal the comm of the process,
+                otherwise name is searched in the command line.
+            regex: If True, name is a regular expression searched in the
+                command line (or matched against the whole comm if exact).
+            max_age, full: See snapshot.
+        """
+
+        return self.find_many([name], exact, regex, max_age, full)[name]
+
+    def find_many(self, names, exact=False, regex=False, max_age=0,
+                  full=False):
+        """Look up many names in a single scan, see find.
+
+        Returns:
+            A dict that maps each name to the sorted pids.
+        """
+
+        matchers = dict((name, _matcher(name, exact, regex))
+                        for name in names)
+        result = dict((name, []) for name in names)
+        for info in self.snapshot(max_age, full):
+            for name, match in matchers.items():
+                if match(info):
+                    result[name].append(info.pid)
+        return result
+
+
+def _matcher(name, exact, regex):
+    if regex and exact:
+        pattern = re.compile(r'(?:%s)\Z' % name)
+        return lambda info: pattern.match(info.comm) is not None
+    if regex:
+        pattern = re.compile(name)
+        return lambda info: pattern.search(info.cmdline) is not None
+    if exact:
+        return lambda info: info.comm == name
+    return lambda info: name in info.cmdline
+
+
+_table = ProcessTable()
+
+
+def find(name, exact=False, regex=False, max_age=0, full=False):
+    """Find the processes in the process-wide ProcessTable, see
+    ProcessTable.find.
+    """
+
+    return _table.find(name, exact, regex, max_age, full)
+
+
+def find_many(names, exact=False, regex=False, max_age=0, full=False):
+    return _table.find_many(names, exact, regex, max_age, full)
@@ -1,11 +1,19 @@
 #!/usr/bin/python
 # -*- encoding=utf8 -*-
 
+import collections
+import errno
 import os
-import subprocess
+import Queue
+import select
 import signal
+import socket
+import stat
+import subprocess
+import sys
 import threading
 import time
+import traceback
 
 
 def system(my_cmd):
@@ -43,61 +51,647 @@ def sh(cmd, raise_exception=False, timeout=None):
             raise Exception("Execute cmd:%s failed.\nstdout:%s\nstderr:%s" %
                             (cmd, stdoutdata, stderrdata))
         return p.returncode, stdoutdata, stderrdata
-    else:
-        p = None
-        result = [None, 0, "", "Timeout"]
-
-        def target(result):
-            p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
-                                 stderr=subprocess.PIPE, preexec_fn=os.setsid)
-            result[0] = p
-            (result[2], result[3]) = p.communicate()
-            result[1] = p.returncode
-            if raise_exception and p.returncode != 0:
-                raise Exception("Execute cmd:%s failed.\nstdout:%s\nstderr:%s" %
-                                (cmd, result[2], result[3]))
-
-        thread = threading.Thread(target=target, kwargs={'result': result})
-        thread.start()
-        thread.join(timeout)
-        if thread.is_alive():
-            # Timeout
-            p = result[0]
-            wait_time = 5
-            while p is None:
-                time.sleep(1)
-                p = result[0]
-                wait_time -= wait_time
-                if wait_time == 0:
-                    exit(1)
-            os.killpg(os.getpgid(p.pid), signal.SIGTERM)
-            thread.join()
-            if raise_exception:
-                raise Exception("Execute cmd:%s failed, timeout:%d." % (
-                    cmd, timeout))
-        return result[1], result[2].encode('unicode-escape') \
-            .decode('unicode-escape'), result[3].encode('unicode-escape') \
-                   .decode('unicode-escape')
 
+    command = Command(cmd, timeout=timeout)
+    loop = CmdLoop()
+    loop.spawn(command)
+    loop.run()
+    if raise_exception and command.timed_out:
+        raise Exception("Execute cmd:%s failed, timeout:%d." % (cmd, timeout))
+    if raise_exception and command.returncode != 0:
+        raise Exception("Execute cmd:%s failed.\nstdout:%s\nstderr:%s" %
+                        (cmd, command.stdout, command.stderr))
+    return command.result()
 
-def ssh(host, cmd):
-    """Execute a command over ssh. 
-    Returns
-        The (result code, stdout, stderr).
+
+# 超时后先向进程组发送SIGTERM，若在该时间（秒）内仍未结束则发送SIGKILL
+KILL_GRACE_PERIOD = 5
+# 管道关闭后等待子进程退出时的轮询间隔（秒）
+REAP_INTERVAL = 0.01
+READ_SIZE = 65536
+
+
+class Command(object):
+    """A shell command run as a child process by a CmdLoop.
+
+    The child runs in its own process group, so that the whole group can be
+    killed when the deadline is reached.
+
+    Args:
+        cmd: The shell command.
+        timeout: If not None, the process group is terminated after timeout
+            seconds.
+        on_stdout: If not None, on_stdout(command, data) is called for each
+            chunk read from the standard output.
+        on_stderr: The same as on_stdout, for the standard error output.
+        on_exit: If not None, on_exit(command) is called when the command
+            finished.
+        capture: If True, the outputs are kept and can be read from stdout
+            and stderr after the command finished.
+    """
+
+    def __init__(self, cmd, timeout=None, on_stdout=None, on_stderr=None,
+                 on_exit=None, capture=True):
+        self.cmd = cmd
+        self.timeout = timeout
+        self.on_stdout = on_stdout
+        self.on_stderr = on_stderr
+        self.on_exit = on_exit
+        self.capture = capture
+        self.process = None
+        self.returncode = None
+        self.timed_out = False
+        self.start_time = None
+        self.end_time = None
+        self.deadline = None
+        self.kill_deadline = None
+        self.open_fds = 0
+        self.stdout_chunks = []
+        self.stderr_chunks = []
+
+    @property
+    def stdout(self):
+        return ''.join(self.stdout_chunks)
+
+    @property
+    def stderr(self):
+        return ''.join(self.stderr_chunks)
+
+    @property
+    def elapsed(self):
+        if self.start_time is None:
+            return 0
+        return (self.end_time or time.time()) - self.start_time
+
+    def done(self):
+        return self.returncode is not None
+
+    def result(self):
+        """Returns the (returncode, stdout, stderr) of the command."""
+
+        return self.returncode, self.stdout, self.stderr
+
+    def kill(self, sig=signal.SIGTERM):
+        """Send sig to the process group of the command."""
+
+        if self.process is None or self.process.returncode is not None:
+            return
+        try:
+            os.killpg(self.process.pid, sig)
+        except OSError:
+            pass
+
+
+class CmdLoop(object):
+    """A single-threaded event loop that runs shell commands as child
+    processes.
+
+    The pipes of all the children are multiplexed with poll(), and the
+    deadlines are enforced by the poll timeout, so no thread is needed per
+    command and a timeout is detected without delay.
+
+    Args:
+        max_running: If not None, at most max_running children run at the
+            same time, the other commands wait in a queue.
+    """
+
+    def __init__(self, max_running=None):
+        self.max_running = max_running
+        self.poller = select.poll()
+        # fd -> (command, stream name)
+        self.fds = {}
+        self.running = set()
+        self.pending = collections.deque()
+
+    def spawn(self, command):
+        """Start the command, or queue it if max_running is reached."""
+
+        if self.max_running is not None \
+                and len(self.running) >= self.max_running:
+            self.pending.append(command)
+        else:
+            self._start(command)
+        return command
+
+    def idle(self):
+        return not self.running and not self.pending
+
+    def run(self, until=None):
+        """Run until all commands finished, or until() returns True."""
+
+        while not self.idle():
+            if until is not None and until():
+                return
+            self.run_once()
+
+    def run_once(self, max_wait=None):
+        """Wait for at most max_wait seconds (None means until the nearest
+        deadline), and handle the events that happened.
+        """
+
+        wait = self._next_wait(max_wait)
+        try:
+            events = self.poller.poll(None if wait is None else
+                                      int(wait * 1000 + 0.5))
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, _ in events:
+            self._read(fd)
+        self._check_deadlines()
+        self._reap()
+
+    def _start(self, command):
+        command.start_time = time.time()
+        if command.timeout is not None:
+            command.deadline = command.start_time + command.timeout
+        try:
+            command.process = subprocess.Popen(
+                command.cmd, shell=True, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, preexec_fn=os.setsid)
+        except OSError as e:
+            command.stderr_chunks.append(str(e))
+            self._finish(command, 1)
+            return
+        for stream, name in ((command.process.stdout, 'stdout'),
+                             (command.process.stderr, 'stderr')):
+            fd = stream.fileno()
+            self.fds[fd] = (command, name)
+            self.poller.register(fd, select.POLLIN | select.POLLPRI)
+        command.open_fds = 2
+        self.running.add(command)
+
+    def _next_wait(self, max_wait):
+        now = time.time()
+        wait = max_wait
+        for command in self.running:
+            if command.open_fds == 0:
+                return REAP_INTERVAL
+            for deadline in (command.deadline, command.kill_deadline):
+                if deadline is not None:
+                    left = max(deadline - now, 0)
+                    if wait is None or left < wait:
+                        wait = left
+        return wait
+
+    def _read(self, fd):
+        command, name = self.fds[fd]
+        try:
+            data = os.read(fd, READ_SIZE)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return
+            data = ''
+        if not data:
+            self._close_fd(fd)
+            return
+        if command.capture:
+            getattr(command, name + '_chunks').append(data)
+        callback = getattr(command, 'on_' + name)
+        if callback is not None:
+            callback(command, data)
+
+    def _close_fd(self, fd):
+        command, name = self.fds.pop(fd)
+        self.poller.unregister(fd)
+        getattr(command.process, name).close()
+        command.open_fds -= 1
+
+    def _check_deadlines(self):
+        now = time.time()
+        for command in list(self.running):
+            if command.deadline is not None and now >= command.deadline:
+                command.deadline = None
+                command.timed_out = True
+                command.kill(signal.SIGTERM)
+                command.kill_deadline = now + KILL_GRACE_PERIOD
+            elif command.kill_deadline is not None \
+                    and now >= command.kill_deadline:
+                command.kill_deadline = None
+                command.kill(signal.SIGKILL)
+                # 脱离进程组的后代进程可能仍持有管道，不再等待其关闭
+                for fd, (c, _) in self.fds.items():
+                    if c is command:
+                        self._close_fd(fd)
+
+    def _reap(self):
+        for command in list(self.running):
+            if command.open_fds == 0:
+                rc = command.process.poll()
+                if rc is not None:
+                    self._finish(command, rc)
+
+    def _finish(self, command, rc):
+        self.running.discard(command)
+        command.returncode = rc
+        command.end_time = time.time()
+        while self.pending and (self.max_running is None or
+                                len(self.running) < self.max_running):
+            self._start(self.pending.popleft())
+        if command.on_exit is not None:
+            command.on_exit(command)
+
+
+def sh_all(cmds, timeout=None, max_running=None):
+    """Execute many shell commands concurrently in one CmdLoop.
+
+    Args:
+        cmds: A list of shell commands.
+        timeout: The timeout of each command, see sh.
+        max_running: The maximum number of commands that run at the same
+            time, None means no limit.
+
+    Returns:
+        A list of (returncode, stdout, stderr), in the order of cmds.
+    """
+
+    loop = CmdLoop(max_running)
+    commands = [loop.spawn(Command(cmd, timeout=timeout)) for cmd in cmds]
+    loop.run()
+    return [command.result() for command in commands]
+
+
+STREAM_TAIL_LINES = 100
+# 一行超过该长度时不再等待换行符，直接输出，保证内存占用有上限
+STREAM_MAX_LINE = 1024 * 1024
+
+
+class CmdStream(object):
+    """The output of a running command, consumed as it arrives.
+
+    Iterating over a CmdStream yields the lines of the standard output (or
+    the raw chunks if chunked is True) while the command is still running,
+    so the memory used does not depend on the size of the output. The last
+    tail lines of the standard output and the standard error are kept in
+    ring buffers for error reporting.
+
+    Args:
+        cmd: A shell command.
+        timeout: See sh.
+        tail: The number of lines kept in stdout_tail and stderr_tail.
+        chunked: If True, yield the chunks read from the pipe instead of
+            lines.
+        on_line: If not None, on_line(line) is called for each line (or
+            chunk) instead of yielding it, use wait() to run the command.
+        on_stderr: If not None, on_stderr(line) is called for each line of
+            the standard error output.
+    """
+
+    def __init__(self, cmd, timeout=None, tail=STREAM_TAIL_LINES,
+                 chunked=False, on_line=None, on_stderr=None):
+        self.chunked = chunked
+        self.on_line = on_line
+        self.on_stderr_line = on_stderr
+        self.stdout_tail = collections.deque(maxlen=tail)
+        self.stderr_tail = collections.deque(maxlen=tail)
+        self.ready = collections.deque()
+        self.partial = {'stdout': '', 'stderr': ''}
+        self.loop = CmdLoop()
+        self.command = self.loop.spawn(Command(
+            cmd, timeout=timeout, on_stdout=self._on_stdout,
+            on_stderr=self._on_stderr, on_exit=self._on_exit, capture=False))
+
+    @property
+    def returncode(self):
+        return self.command.returncode
+
+    @property
+    def timed_out(self):
+        return self.command.timed_out
+
+    def __iter__(self):
+        while True:
+            while self.ready:
+                yield self.ready.popleft()
+            if self.command.done():
+                return
+            self.loop.run_once()
+
+    def wait(self):
+        """Consume the remaining output and wait for the command.
+
+        Returns:
+            A tuple of (returncode, the tail of stdout, the tail of stderr).
+        """
+
+        for _ in self:
+            pass
+        return self.returncode, ''.join(self.stdout_tail), \
+            ''.join(self.stderr_tail)
+
+    def close(self):
+        """Kill the command if it is still running."""
+
+        if not self.command.done():
+            self.command.kill(signal.SIGKILL)
+            self.loop.run()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _on_stdout(self, command, data):
+        if self.chunked:
+            self._emit_stdout(data)
+            return
+        for line in self._split_lines('stdout', data):
+            self._emit_stdout(line)
+
+    def _on_stderr(self, command, data):
+        for line in self._split_lines('stderr', data):
+            self._emit_stderr(line)
+
+    def _on_exit(self, command):
+        for name, emit in (('stdout', self._emit_stdout),
+                           ('stderr', self._emit_stderr)):
+            if self.partial[name]:
+                emit(self.partial[name])
+                self.partial[name] = ''
+
+    def _split_lines(self, name, data):
+        lines = (self.partial[name] + data).splitlines(True)
+        if lines and not lines[-1].endswith('\n') \
+                and len(lines[-1]) < STREAM_MAX_LINE:
+            self.partial[name] = lines.pop()
+        else:
+            self.partial[name] = ''
+        return lines
+
+    def _emit_stdout(self, line):
+        self.stdout_tail.append(line)
+        if self.on_line is not None:
+            self.on_line(line)
+        else:
+            self.ready.append(line)
+
+    def _emit_stderr(self, line):
+        self.stderr_tail.append(line)
+        if self.on_stderr_line is not None:
+            self.on_stderr_line(line)
+
+
+def stream(cmd, timeout=None, tail=STREAM_TAIL_LINES, chunked=False,
+           on_line=None, on_stderr=None):
+    """Execute a shell command and consume its output as it arrives.
+
+    For example:
+        s = stream('lsof')
+        for line in s:
+            parse(line)
+        if s.returncode != 0:
+            log.error(''.join(s.stderr_tail))
+
+    Returns:
+        A CmdStream, see CmdStream for the arguments.
+    """
+
+    return CmdStream(cmd, timeout=timeout, tail=tail, chunked=chunked,
+                     on_line=on_line, on_stderr=on_stderr)
+
+
+# ssh连接复用（OpenSSH ControlMaster）相关配置
+SSH_MULTIPLEX = True
+# 控制socket所在目录，必须属于当前用户且权限为0700，否则不复用连接
+SSH_CONTROL_DIR = '~/.ssh/mux'
+# master连接空闲超过该时间（秒）后被关闭
+SSH_IDLE_TIMEOUT = 300
+# 与sshd默认的MaxSessions保持一致
+SSH_MAX_SESSIONS_PER_HOST = 10
+SSH_HEALTH_CHECK_INTERVAL = 30
+
+SSH_BASE_OPTS = "-o ConnectTimeout=15 -o StrictHostKeyChecking=no " \
+                "-o TcpKeepAlive=yes -o ServerAliveInterval=30 " \
+                "-o ServerAliveCountMax=3 -o BatchMode=yes"
+
+
+class _SshMaster(object):
+    """Book-keeping of one persistent ssh master connection."""
+
+    def __init__(self, user, host, max_sessions):
+        self.user = user
+        self.host = host
+        self.lock = threading.Lock()
+        self.sessions = threading.BoundedSemaphore(max_sessions)
+        self.active = 0
+        self.last_used = time.time()
+
+
+class SshPool(object):
+    """A pool of persistent ssh master connections keyed by user@host.
+
+    Every ssh command to the same host is multiplexed over one master
+    connection (OpenSSH ControlMaster). There is no separate step to start
+    a master: the first command to a host becomes the master and stays in
+    the background after it finishes (ControlPersist), so only that command
+    pays for the TCP and key-exchange handshake, and an unreachable host
+    costs a single connect timeout. Masters exit after being idle for
+    idle_timeout seconds, at most max_sessions commands run over one master
+    at the same time, and a master that has not been used for
+    health_check_interval seconds is checked before reuse.
+    """
+
+    def __init__(self, control_dir=SSH_CONTROL_DIR,
+                 idle_timeout=SSH_IDLE_TIMEOUT,
+                 max_sessions=SSH_MAX_SESSIONS_PER_HOST,
+                 health_check_interval=SSH_HEALTH_CHECK_INTERVAL):
+        self.control_dir = os.path.expanduser(control_dir)
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.health_check_interval = health_check_interval
+        self.lock = threading.Lock()
+        self.masters = {}
+
+    def control_path(self, user, host):
+        return os.path.join(self.control_dir, '%s@%s' % (user or 'default',
+                                                          host))
+
+    def control_opts(self, user, host):
+        """The ssh options that make a command use the master of user@host,
+        or become the master if there is none. If the control socket can not
+        be created, ssh falls back to a direct connection. An empty string
+        (no multiplexing) is returned if the control directory is not safe,
+        see _ensure_control_dir.
+        """
+
+        if not self._ensure_control_dir():
+            return ""
+        return "-o ControlMaster=auto -o ControlPath=%s " \
+               "-o ControlPersist=%d" % (self.control_path(user, host),
+                                         self.idle_timeout)
+
+    def acquire(self, user, host):
+        """Take a session slot on the master of user@host. Blocks if
+        max_sessions commands are already running on this host.
+
+        Returns:
+            The ssh options to be used by the command.
+        """
+
+        self.evict_idle()
+        key = (user, host)
+        with self.lock:
+            master = self.masters.get(key)
+            if master is None:
+                master = _SshMaster(user, host, self.max_sessions)
+                self.masters[key] = master
+            master.active += 1
+        master.sessions.acquire()
+        with master.lock:
+            self._check_master(master)
+        return self.control_opts(user, host)
+
+    def release(self, user, host):
+        with self.lock:
+            master = self.masters.get((user, host))
+            if master is None:
+                return
+            master.active -= 1
+            master.last_used = time.time()
+        master.sessions.release()
+
+    def check(self, user, host):
+        """Return True if the master of user@host is alive."""
+
+        return self._control_cmd(user, host, "check") == 0
+
+    def evict_idle(self):
+        """Forget the masters that have been idle for too long, they exit by
+        themselves (ControlPersist).
+        """
+
+        now = time.time()
+        with self.lock:
+            for key, master in self.masters.items():
+                if master.active == 0 \
+                        and now - master.last_used > self.idle_timeout:
+                    del self.masters[key]
+
+    def close_all(self):
+        with self.lock:
+            masters = self.masters.values()
+            self.masters = {}
+        for master in masters:
+            if os.path.exists(self.control_path(master.user, master.host)):
+                self._control_cmd(master.user, master.host, "exit")
+
+    def _check_master(self, master):
+        if time.time() - master.last_used < self.health_check_interval:
+            return
+        if not self._ensure_control_dir():
+            return
+        path = self.control_path(master.user, master.host)
+        if os.path.exists(path) and not self.check(master.user, master.host):
+            # master已失效，删除socket文件，下一条命令成为新的master
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _ensure_control_dir(self):
+        """Create the control directory if needed, and return True if it
+        is safe to use: a directory (not a symlink) owned by the current
+        user and not accessible by others. Otherwise another user could
+        plant control sockets and receive our commands and their output.
+        """
+
+        try:
+            os.makedirs(self.control_dir, 0o700)
+        except OSError:
+            # 已存在（或无法创建，由下面的检查发现）
+            pass
+        try:
+            st = os.lstat(self.control_dir)
+        except OSError:
+            return False
+        return stat.S_ISDIR(st.st_mode) and st.st_uid == os.geteuid() \
+            and stat.S_IMODE(st.st_mode) & 0o077 == 0
+
+    def _control_cmd(self, user, host, op):
+        user_at = user + "@" if user != "" else ""
+        cmd = "ssh -O %s -o ControlPath=%s %s%s" % (
+            op, self.control_path(user, host), user_at, host)
+        return _call_quietly(cmd)
+
+
+_ssh_pool = None
+_ssh_pool_lock = threading.Lock()
+
+
+def get_ssh_pool():
+    """Return the process-wide ssh connection pool."""
+
+    global _ssh_pool
+    with _ssh_pool_lock:
+        if _ssh_pool is None:
+            _ssh_pool = SshPool()
+    return _ssh_pool
+
+
+def _call_quietly(cmd):
+    """Run a command with all standard streams bound to /dev/null."""
+
+    devnull = open(os.devnull, 'r+')
+    try:
+        return subprocess.call(cmd, shell=True, stdin=devnull, stdout=devnull,
+                               stderr=devnull)
+    finally:
+        devnull.close()
+
+
+def gen_ssh_cmd(user, host, cmd, extra_opts=""):
+    """Generate the ssh command that runs cmd on host.
+
+    Returns:
+        The ssh command, or None if cmd contains both " and '.
     """
 
     cmd_separator = "'"
     if '"' in cmd and "'" in cmd:
-        return 1, '', """cmd:%s can not contain both " and '"""
+        return None
     if "'" in cmd:
         cmd_separator = '"'
 
-    ssh_cmd = "ssh -o ConnectTimeout=15 -o StrictHostKeyChecking=no -o \
-           TcpKeepAlive=yes -o ServerAliveInterval=30 -o ServerAliveCountMax=3\
-            -o BatchMode=yes %s %s%s%s" % (host, cmd_separator, cmd,
-                                           cmd_separator)
+    user_at = user + "@" if user != "" else ""
+    return "ssh %s %s %s%s %s%s%s" % (SSH_BASE_OPTS, extra_opts, user_at, host,
+                                      cmd_separator, cmd, cmd_separator)
+
+
+def _ssh(user, host, cmd, timeout=None, stdin_file=None):
+    """Execute a command over ssh, reusing the pooled master connection of
+    user@host if SSH_MULTIPLEX is enabled. If stdin_file is not None, the
+    standard input of the remote command is read from the local file.
+    """
+
+    extra_opts = ""
+    pool = None
+    if SSH_MULTIPLEX:
+        pool = get_ssh_pool()
+        extra_opts = pool.control_opts(user, host)
+    ssh_cmd = gen_ssh_cmd(user, host, cmd, extra_opts)
+    if ssh_cmd is None:
+        return 1, '', """cmd:%s can not contain both " and '""" % cmd
+    if stdin_file is not None:
+        ssh_cmd += " < %s" % stdin_file
+    if pool is None:
+        return sh(ssh_cmd, timeout=timeout)
+
+    pool.acquire(user, host)
+    try:
+        return sh(ssh_cmd, timeout=timeout)
+    finally:
+        pool.release(user, host)
+
+
+def ssh(host, cmd):
+    """Execute a command over ssh. 
+    Returns
+        The (result code, stdout, stderr).
+    """
 
-    return sh(ssh_cmd)
+    return _ssh("", host, cmd)
 
 
 def ssh_with_timeout(host, cmd, timeout):
@@ -109,18 +703,7 @@ def ssh_with_timeout(host, cmd, timeout):
     :return:
     """
 
-    cmd_separator = "'"
-    if '"' in cmd and "'" in cmd:
-        return 1, '', """cmd:%s can not contain both " and '"""
-    if "'" in cmd:
-        cmd_separator = '"'
-
-    ssh_cmd = "ssh -o ConnectTimeout=15 -o StrictHostKeyChecking=no -o \
-           TcpKeepAlive=yes -o ServerAliveInterval=30 -o ServerAliveCountMax=3\
-            -o BatchMode=yes %s %s%s%s" % (host, cmd_separator, cmd,
-                                           cmd_separator)
-
-    return sh(ssh_cmd, timeout=timeout)
+    return _ssh("", host, cmd, timeout=timeout)
 
 
 def ssh2(host_ips, cmd):
@@ -136,11 +719,11 @@ def ssh2(host_ips, cmd):
         host is returned. 
     """
 
-    available_ips = [ip for ip in host_ips if ping(ip)]
-    if len(available_ips) == 0:
+    available_ip = get_available_ip(host_ips)
+    if available_ip is None:
         return ssh(host_ips[-1], cmd)
     else:
-        return ssh(available_ips[0], cmd)
+        return ssh(available_ip, cmd)
 
 
 def ssh2_with_timeout(host_ips, cmd, timeout):
@@ -152,11 +735,22 @@ def ssh2_with_timeout(host_ips, cmd, timeout):
     :return:
     """
 
-    available_ips = [ip for ip in host_ips if ping(ip)]
-    if len(available_ips) == 0:
+    available_ip = get_available_ip(host_ips)
+    if available_ip is None:
         return ssh_with_timeout(host_ips[-1], cmd, timeout)
     else:
-        return ssh_with_timeout(available_ips[0], cmd, timeout)
+        return ssh_with_timeout(available_ip, cmd, timeout)
+
+
+def ssh_with_stdin(host, cmd, stdin_file, timeout=None, user=""):
+    """Execute a command over ssh, its standard input is read from the
+    local file stdin_file.
+
+    Returns
+        The (result code, stdout, stderr).
+    """
+
+    return _ssh(user, host, cmd, timeout=timeout, stdin_file=stdin_file)
 
 
 def ssh3(user, host, cmd):
@@ -169,19 +763,109 @@ def ssh3(user, host, cmd):
             The (result code, stdout, stderr).
         """
 
-    cmd_separator = "'"
-    if '"' in cmd and "'" in cmd:
-        return 1, '', """cmd:%s can not contain both " and '"""
-    if "'" in cmd:
-        cmd_separator = '"'
+    return _ssh(user, host, cmd)
 
-    user_at = user + "@" if user != "" else ""
-    ssh_cmd = "ssh -o ConnectTimeout=15 -o StrictHostKeyChecking=no -o \
-               TcpKeepAlive=yes -o ServerAliveInterval=30 -o ServerAliveCountMax=3\
-                -o BatchMode=yes %s%s %s%s%s" % (user_at, host, cmd_separator,
-                                                 cmd, cmd_separator)
 
-    return sh(ssh_cmd)
+FANOUT_CONCURRENCY = 32
+
+# fanout中每个主机的执行结果，elapsed为耗时（秒）
+FanoutResult = collections.namedtuple('FanoutResult',
+                                      ['rc', 'stdout', 'stderr', 'elapsed'])
+
+
+def _bounded_imap(func, items, concurrency):
+    """Call func on each item with at most concurrency worker threads.
+
+    Yields (item, result) in the order that the calls complete. If the
+    caller stops iterating, the remaining items are not started. If func
+    raises, the exception is raised in the caller and the remaining items
+    are not started.
+    """
+
+    items = list(items)
+    todo = Queue.Queue()
+    for item in items:
+        todo.put(item)
+    done = Queue.Queue()
+    stopped = threading.Event()
+
+    def worker():
+        while not stopped.is_set():
+            try:
+                item = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                done.put((item, func(item), None))
+            except Exception:
+                done.put((item, None, sys.exc_info()))
+
+    workers = [threading.Thread(target=worker)
+               for _ in range(min(concurrency, len(items)))]
+    for t in workers:
+        t.start()
+    try:
+        for _ in range(len(items)):
+            item, result, exc_info = done.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield item, result
+    finally:
+        stopped.set()
+
+
+def ifanout(hosts, cmd, concurrency=FANOUT_CONCURRENCY, timeout=None, user="",
+            stdin_file=None):
+    """Run cmd on every host over ssh with a bounded pool of workers.
+
+    Args:
+        hosts: A list of hosts.
+        cmd: The shell command to be executed on each host.
+        concurrency: The maximum number of hosts that run cmd at the same
+            time.
+        timeout: If not None, the command on a host is terminated after
+            timeout seconds.
+        user: The login user, the default user of ssh is used if empty.
+        stdin_file: If not None, the standard input of cmd on each host is
+            read from this local file.
+
+    Returns:
+        A generator that yields (host, FanoutResult) as soon as the command
+        on that host finishes.
+    """
+
+    def run(host):
+        start = time.time()
+        try:
+            rc, stdout, stderr = _ssh(user, host, cmd, timeout=timeout,
+                                      stdin_file=stdin_file)
+        except Exception:
+            rc, stdout, stderr = 1, '', traceback.format_exc()
+        return FanoutResult(rc, stdout, stderr, time.time() - start)
+
+    return _bounded_imap(run, hosts, concurrency)
+
+
+def fanout(hosts, cmd, concurrency=FANOUT_CONCURRENCY, timeout=None, user="",
+           callback=None, stdin_file=None):
+    """Run cmd on every host over ssh in parallel, see ifanout.
+
+    Args:
+        callback: If not None, callback(host, result) is called as soon as
+            the command on a host finishes.
+
+    Returns:
+        A dict that maps each host to its FanoutResult(rc, stdout, stderr,
+        elapsed).
+    """
+
+    report = {}
+    for host, result in ifanout(hosts, cmd, concurrency, timeout, user,
+                                stdin_file):
+        report[host] = result
+        if callback is not None:
+            callback(host, result)
+    return report
 
 
 def gen_scp_cmd(src_host, src_file_or_dir, dest_host, dest_path,
@@ -232,7 +916,7 @@ def gen_scp_cmd(src_host, src_file_or_dir, dest_host, dest_path,
 
 
 def gen_base_scp_cmd(src_host, src_file_or_dir, dest_host, dest_path,
-                     src_user="root", dest_user="root"):
+                     src_user="root", dest_user="root", recursive=False):
     """
     生成基础scp命令
     :param src_host:
@@ -241,12 +925,14 @@ def gen_base_scp_cmd(src_host, src_file_or_dir, dest_host, dest_path,
     :param dest_path:
     :param src_user:
     :param dest_user:
-    :param args:
+    :param recursive: 源路径为远端目录时需指定（本地目录会自动识别）
     :return:
     """
     # 限速100MB（scp -l 的单位为Kbit/s）
     # BatchMode=yes： 在没有配置无密访问时直接报错而不是卡住
     base_args = ["-l", str(100 * 1024 * 8), "-o", "BatchMode=yes"]
+    if recursive:
+        base_args = ["-r"] + base_args
     return gen_scp_cmd(src_host, src_file_or_dir, dest_host, dest_path,
                        src_user, dest_user, *base_args)
 
@@ -273,11 +959,11 @@ def scp2(file_or_dir, dest_host_ips, dest_path):
         0 if succeed, otherwise a non-zero value is returned.
     """
 
-    available_ips = [ip for ip in dest_host_ips if ping(ip)]
-    if len(available_ips) == 0:
+    available_ip = get_available_ip(dest_host_ips)
+    if available_ip is None:
         return 1
     else:
-        return scp(file_or_dir, available_ips[0], dest_path)
+        return scp(file_or_dir, available_ip, dest_path)
 
 
 def scp_remote_to_local(remote_host_ips, remote_path, local_path):
@@ -293,10 +979,10 @@ def scp_remote_to_local(remote_host_ips, remote_path, local_path):
         0 if succeed, otherwise a non-zero value is returned.
     """
 
-    available_ips = [ip for ip in remote_host_ips if ping(ip)]
-    if len(available_ips) == 0:
+    available_ip = get_available_ip(remote_host_ips)
+    if available_ip is None:
         return 1
-    scp_cmd = gen_base_scp_cmd(available_ips[0], remote_path, "", local_path)
+    scp_cmd = gen_base_scp_cmd(available_ip, remote_path, "", local_path)
     return system(scp_cmd)
 
 
@@ -334,11 +1020,144 @@ def rsync2(file_or_dir, dest_host_ips, dest_path, exclude_pattens=None):
     if exclude_pattens is None:
         exclude_pattens = []
 
-    available_ips = [ip for ip in dest_host_ips if ping(ip)]
-    if len(available_ips) == 0:
+    available_ip = get_available_ip(dest_host_ips)
+    if available_ip is None:
         return 1, "no available ip", "no available ip"
     else:
-        return rsync(file_or_dir, available_ips[0], dest_path, exclude_pattens)
+        return rsync(file_or_dir, available_ip, dest_path, exclude_pattens)
+
+
+# 传输限速（rsync --bwlimit 的单位为KB/s），根据传输结果在上下限之间自适应调整
+TRANSFER_BWLIMIT = 100 * 1024
+TRANSFER_MIN_BWLIMIT = 10 * 1024
+TRANSFER_MAX_BWLIMIT = 1024 * 1024
+TRANSFER_RETRIES = 3
+# 断点续传时未传完的文件保存在目标目录下的该目录中
+TRANSFER_PARTIAL_DIR = '.rsync-partial'
+# 可以通过重试恢复的rsync退出码：网络错误、协议数据流错误、超时。
+# 23（部分传输）多为权限或文件消失等非链路问题，重试和降速都无益
+RSYNC_RETRYABLE_RCS = (10, 12, 30, 35, 255)
+
+
+class AdaptiveBandwidth(object):
+    """The bandwidth limit of each host, adjusted from the results of the
+    transfers: a successful transfer raises the limit by a fixed step, a
+    failed one halves it.
+    """
+
+    def __init__(self, initial=TRANSFER_BWLIMIT, minimum=TRANSFER_MIN_BWLIMIT,
+                 maximum=TRANSFER_MAX_BWLIMIT):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = max(initial // 4, 1)
+        self.lock = threading.Lock()
+        self.limits = {}
+
+    def get(self, host):
+        with self.lock:
+            return self.limits.get(host, self.initial)
+
+    def success(self, host):
+        with self.lock:
+            limit = self.limits.get(host, self.initial)
+            self.limits[host] = min(limit + self.step, self.maximum)
+
+    def failure(self, host):
+        with self.lock:
+            limit = self.limits.get(host, self.initial)
+            self.limits[host] = max(limit // 2, self.minimum)
+
+
+_bandwidth = AdaptiveBandwidth()
+
+
+def gen_transfer_cmd(file_or_dir, dest_host, dest_path, user="", resume=True,
+                     checksum=True, bwlimit=None, exclude_pattens=None,
+                     ssh_opts=""):
+    """Generate the rsync command used by transfer."""
+
+    args = ["-a"]
+    if resume:
+        # 续传时以未传完的文件为基准，只传输缺少的部分
+        args.append("--partial-dir=%s" % TRANSFER_PARTIAL_DIR)
+    if checksum:
+        # 按内容而不是修改时间和大小判断文件是否需要传输
+        args.append("--checksum")
+    if bwlimit is not None:
+        args.append("--bwlimit=%d" % bwlimit)
+    args.extend(["--exclude=%s" % patten for patten in exclude_pattens or []])
+    user_at = user + "@" if user != "" else ""
+    return 'rsync %s -e "ssh %s %s" %s %s%s:%s' % (
+        " ".join(args), SSH_BASE_OPTS, ssh_opts, file_or_dir, user_at,
+        dest_host, dest_path)
+
+
+def transfer(file_or_dir, dest_host, dest_path, user="", resume=True,
+             checksum=True, bwlimit=None, exclude_pattens=None,
+             retries=TRANSFER_RETRIES, timeout=None):
+    """Copy a file or directory to a remote host, only the changed bytes are
+    moved.
+
+    Args:
+        file_or_dir: A local file or directory.
+        dest_host: The destination host.
+        dest_path: The path on the destination host.
+        user: The login user, the default user of ssh is used if empty.
+        resume: If True, an interrupted transfer is resumed from the
+            partial files on the destination.
+        checksum: If True, the files already present on the destination are
+            skipped by comparing their content hash instead of their
+            modification time and size.
+        bwlimit: The bandwidth limit in KB/s. If None, the limit of the host
+            is adjusted from the previous transfers: it is raised after a
+            success and halved after a failure.
+        exclude_pattens: The patterns of the files to be excluded.
+        retries: The number of retries after a network failure.
+        timeout: The timeout in seconds of each attempt.
+
+    Returns:
+        The (result code, stdout, stderr) of the last attempt.
+    """
+
+    if not os.path.exists(file_or_dir):
+        return 1, "", "%s does not exist." % file_or_dir
+
+    ssh_opts = ""
+    pool = None
+    if SSH_MULTIPLEX:
+        pool = get_ssh_pool()
+        ssh_opts = pool.control_opts(user, dest_host)
+        pool.acquire(user, dest_host)
+    try:
+        for _ in range(retries + 1):
+            limit = bwlimit if bwlimit is not None \
+                else _bandwidth.get(dest_host)
+            cmd = gen_transfer_cmd(file_or_dir, dest_host, dest_path, user,
+                                   resume, checksum, limit, exclude_pattens,
+                                   ssh_opts)
+            rc, stdout, stderr = sh(cmd, timeout=timeout)
+            if rc == 0:
+                _bandwidth.success(dest_host)
+                break
+            if rc not in RSYNC_RETRYABLE_RCS and rc >= 0:
+                break
+            _bandwidth.failure(dest_host)
+    finally:
+        if pool is not None:
+            pool.release(user, dest_host)
+    return rc, stdout, stderr
+
+
+def transfer2(file_or_dir, dest_host_ips, dest_path, **kwargs):
+    """The same as transfer, the file is copied through any of the
+    available IPs in dest_host_ips.
+    """
+
+    available_ip = get_available_ip(dest_host_ips)
+    if available_ip is None:
+        return 1, "no available ip", "no available ip"
+    return transfer(file_or_dir, available_ip, dest_path, **kwargs)
 
 
 def scp_with_error_msg(file_or_dir, dest_host, dest_path):
@@ -364,11 +1183,11 @@ def scp2_with_error_msg(file_or_dir, dest_host_ips, dest_path):
         0 if succeed, otherwise a non-zero value is returned.
     """
 
-    available_ips = [ip for ip in dest_host_ips if ping(ip)]
-    if len(available_ips) == 0:
+    available_ip = get_available_ip(dest_host_ips)
+    if available_ip is None:
         return 1
     else:
-        return scp_with_error_msg(file_or_dir, available_ips[0], dest_path)
+        return scp_with_error_msg(file_or_dir, available_ip, dest_path)
 
 
 def scp3(file_or_dir, user_name, dest_hosts, dest_path):
@@ -435,40 +1254,206 @@ def scp_src_to_remote(src_ips, src_path, dest_host_ips, dest_path):
         0 if succeed, otherwise a non-zero value is returned.
     """
 
-    available_src_ips = [ip for ip in src_ips if ping(ip)]
-    if len(available_src_ips) == 0:
+    available_src_ip = get_available_ip(src_ips)
+    if available_src_ip is None:
         return 1
 
-    available_ips = [ip for ip in dest_host_ips if ping(ip)]
-    if len(available_ips) == 0:
+    available_ip = get_available_ip(dest_host_ips)
+    if available_ip is None:
         return 1
     else:
-        scp_cmd = gen_base_scp_cmd(available_src_ips[0], src_path,
-                                   available_ips[0], dest_path)
+        scp_cmd = gen_base_scp_cmd(available_src_ip, src_path,
+                                   available_ip, dest_path)
         return system(scp_cmd)
 
 
-def execute_file(host, file, dest_dir='/tmp'):
+DISTRIBUTE_DEGREE = 2
+
+
+def gen_checksum_cmd(path):
+    """Generate a command that prints the md5 checksum of a file, or of all
+    the files under a directory.
+    """
+
+    return "if [ -d %(path)s ]; then cd %(path)s && find . -type f -print0 " \
+           "| sort -z | xargs -0 md5sum | md5sum; else md5sum < %(path)s; " \
+           "fi" % {'path': path}
+
+
+def distribute(file_or_dir, dest_hosts, dest_path, user_name="root",
+               degree=DISTRIBUTE_DEGREE, verify=True, progress=None,
+               concurrency=FANOUT_CONCURRENCY):
+    """Copy a file or directory to many hosts through a relay tree.
+
+    The local host only sends the file to degree hosts. In every round,
+    each host that already has the file relays it to degree more hosts
+    (scp run on that host over ssh), so N hosts are served in O(log N) rounds and
+    the NIC of the local host is not the bottleneck. The hosts must be
+    able to ssh to each other without password.
+
+    Args:
+        file_or_dir: A local file or directory.
+        dest_hosts: A list of IPs, each IP represents a host.
+        dest_path: The directory on the destination hosts.
+        user_name: The login user of the destination hosts.
+        degree: The number of hosts that each host sends the file to in
+            one round.
+        verify: If True, the md5 checksum on each destination is compared
+            with the local one, a mismatch is treated as a failure.
+        progress: If not None, progress(src_host, dest_host, rc, elapsed) is
+            called after each copy, src_host is "" for the local host.
+        concurrency: The maximum number of copies in flight.
+
+    Returns:
+        A dict that maps each destination host to 0 if succeed, otherwise a
+        non-zero value.
+    """
+
+    recursive = os.path.isdir(file_or_dir)
+    remote_path = os.path.join(dest_path,
+                               os.path.basename(file_or_dir.rstrip('/')))
+    checksum = None
+    if verify:
+        rc, stdout, stderr = sh(gen_checksum_cmd(file_or_dir))
+        if rc != 0:
+            return dict((host, rc) for host in dest_hosts)
+        checksum = stdout.split()[0]
+
+    def copy(hop):
+        src_host, dest_host = hop
+        start = time.time()
+        if src_host == "":
+            scp_cmd = gen_base_scp_cmd("", file_or_dir, dest_host, dest_path,
+                                       dest_user=user_name)
+            rc = system(scp_cmd)
+        else:
+            # 在源主机上执行scp，数据直接从源主机发往目的主机。
+            # 本地执行的远端到远端scp（OpenSSH 8.7起）会经由本机中转
+            relay_args = ["-l", str(100 * 1024 * 8), "-o", "BatchMode=yes",
+                          "-o", "StrictHostKeyChecking=no"]
+            if recursive:
+                relay_args = ["-r"] + relay_args
+            scp_cmd = gen_scp_cmd("", remote_path, dest_host, dest_path,
+                                  user_name, user_name, *relay_args)
+            rc = _ssh(user_name, src_host, scp_cmd)[0]
+        if rc == 0 and checksum is not None:
+            rc, stdout, stderr = _ssh(user_name, dest_host,
+                                      gen_checksum_cmd(remote_path))
+            if rc == 0 and stdout.split()[:1] != [checksum]:
+                rc = 1
+        if progress is not None:
+            progress(src_host, dest_host, rc, time.time() - start)
+        return rc
+
+    report = {}
+    holders = [""]
+    pending = collections.deque(dest_hosts)
+    # 中转失败的主机再尝试一次，由其他节点发送
+    attempts = collections.defaultdict(int)
+    while pending:
+        hops = []
+        for src_host in holders:
+            for _ in range(degree):
+                if not pending:
+                    break
+                dest_host = pending.popleft()
+                attempts[dest_host] += 1
+                hops.append((src_host, dest_host))
+        for (src_host, dest_host), rc in _bounded_imap(copy, hops,
+                                                       concurrency):
+            report[dest_host] = rc
+            if rc == 0:
+                holders.append(dest_host)
+            elif attempts[dest_host] < 2:
+                pending.append(dest_host)
+    return report
+
+
+def get_interpreter(file):
+    """Return the interpreter in the shebang line of a script, /bin/sh is
+    returned if the script has no shebang line.
+    """
+
+    with open(file, 'r') as f:
+        first_line = f.readline()
+    if first_line.startswith('#!') and first_line[2:].strip():
+        return first_line[2:].strip()
+    return '/bin/sh'
+
+
+def is_script(file):
+    """Return True if file is a text file, which can be piped to its
+    interpreter. A file with a NUL byte in its first block (such as an ELF
+    executable) is binary.
+    """
+
+    with open(file, 'rb') as f:
+        return '\0' not in f.read(8192)
+
+
+def execute_file(host, file, dest_dir='/tmp', timeout=None, user=""):
     """Execute a file on remote node. 
-    
+
+    A script is piped to its interpreter over the standard input of one
+    ssh session, so no temporary file is copied to or removed from the
+    remote node. A binary executable is copied to dest_dir, executed and
+    removed.
+
+    Args:
+        timeout: The timeout in seconds of each scp or ssh command, None
+            means no timeout.
+        user: The remote user, "" means the default one (root for scp).
+
     Returns:
         The (result code, stdout, stderr).
     """
 
-    rc = scp(host, file, dest_dir)
+    if not os.path.isfile(file):
+        return 1, "", "%s does not exist." % file
+    if is_script(file):
+        return _ssh(user, host, get_interpreter(file), timeout=timeout,
+                    stdin_file=file)
+
+    scp_cmd = gen_base_scp_cmd("", file, host, dest_dir,
+                               dest_user=user or "root")
+    rc = sh(scp_cmd, timeout=timeout)[0]
     if rc:
-        print 'Scp file:%s to host:%s failed.' % (file, host)
-        return (rc, "", "")
+        return rc, "", "Scp file:%s to host:%s failed." % (file, host)
+    remote_file = '%s/%s' % (dest_dir, os.path.basename(file))
+    # 执行和删除在同一个ssh会话中完成，返回执行的结果码
+    return _ssh(user, host, "chmod +x %s && %s; rc=$?; rm -f %s; exit $rc" % (
+        remote_file, remote_file, remote_file), timeout=timeout)
 
-    filename = os.path.basename(file)
-    my_cmd = '%s/%s' % (dest_dir, filename)
-    (rc, stdout, stderr) = ssh(host, my_cmd)
 
-    # Delete the file on remote node.
-    my_cmd = 'rm -rf %s/%s' % (dest_dir, filename)
-    ssh(host, my_cmd)
+def execute_file_on_hosts(hosts, file, concurrency=FANOUT_CONCURRENCY,
+                          timeout=None, user="", callback=None):
+    """Execute a local file on many hosts concurrently, one ssh session
+    per host for a script, see execute_file and fanout.
+
+    Returns:
+        A dict that maps each host to its FanoutResult(rc, stdout, stderr,
+        elapsed).
+    """
 
-    return (rc, stdout, stderr)
+    if not os.path.isfile(file):
+        return dict((host, FanoutResult(1, "", "%s does not exist." % file, 0))
+                    for host in hosts)
+    if not is_script(file):
+        def run(host):
+            start = time.time()
+            rc, stdout, stderr = execute_file(host, file, timeout=timeout,
+                                              user=user)
+            return FanoutResult(rc, stdout, stderr, time.time() - start)
+
+        report = {}
+        for host, result in _bounded_imap(run, hosts, concurrency):
+            report[host] = result
+            if callback is not None:
+                callback(host, result)
+        return report
+    return fanout(hosts, get_interpreter(file), concurrency=concurrency,
+                  timeout=timeout, user=user, callback=callback,
+                  stdin_file=file)
 
 
 def gen_ping_cmd(ip):
@@ -490,3 +1475,444 @@ def ping(ip):
         return True
     else:
         return False
+
+
+# 主机可达性探测相关配置
+# 探测方式：tcp（连接REACHABILITY_PORT端口）或icmp（ping命令）
+REACHABILITY_PROBE = 'tcp'
+REACHABILITY_PORT = 22
+REACHABILITY_TIMEOUT = 2
+# 可达/不可达结果的缓存时间（秒）
+REACHABILITY_TTL = 30
+REACHABILITY_NEGATIVE_TTL = 5
+
+
+class Reachability(object):
+    """A cache of the reachability of IPs.
+
+    The candidate IPs of a host are probed concurrently and the first IP
+    that answers is returned without waiting for the others. The results
+    are cached for ttl seconds, and the unreachable IPs for negative_ttl
+    seconds.
+
+    Args:
+        probe: 'tcp' connects to port (the ssh port by default), which is
+            what the remote operations really need; 'icmp' runs a single
+            packet ping.
+        timeout: The maximum time in seconds to wait for the answers.
+    """
+
+    def __init__(self, probe=REACHABILITY_PROBE, port=REACHABILITY_PORT,
+                 timeout=REACHABILITY_TIMEOUT, ttl=REACHABILITY_TTL,
+                 negative_ttl=REACHABILITY_NEGATIVE_TTL):
+        if probe not in ('tcp', 'icmp'):
+            raise Exception("Unknown probe:%s" % probe)
+        self.probe = probe
+        self.port = port
+        self.timeout = timeout
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        # ip -> (reachable, expire time)
+        self.cache = {}
+
+    def is_reachable(self, ip):
+        return self.first_reachable([ip]) is not None
+
+    def first_reachable(self, ips):
+        """Return the IP in ips that answers first, or None if no IP is
+        reachable. A cached reachable IP is preferred in the order of ips.
+        """
+
+        cached = self._lookup(ips)
+        for ip in ips:
+            if cached.get(ip) is True:
+                return ip
+        candidates = [ip for ip in ips if ip not in cached]
+        if not candidates:
+            return None
+        results = self._probe(candidates, first_only=True)
+        self._store(results)
+        for ip, reachable in results.items():
+            if reachable:
+                return ip
+        return None
+
+    def reachable_ips(self, ips):
+        """Return all reachable IPs in ips, in the order of ips."""
+
+        cached = self._lookup(ips)
+        candidates = [ip for ip in ips if ip not in cached]
+        if candidates:
+            results = self._probe(candidates, first_only=False)
+            self._store(results)
+            cached.update(results)
+        return [ip for ip in ips if cached.get(ip)]
+
+    def invalidate(self, ip=None):
+        """Forget the cached result of ip, or of all IPs if ip is None."""
+
+        with self.lock:
+            if ip is None:
+                self.cache = {}
+            else:
+                self.cache.pop(ip, None)
+
+    def _lookup(self, ips):
+        now = time.time()
+        cached = {}
+        with self.lock:
+            for ip in ips:
+                entry = self.cache.get(ip)
+                if entry is not None and entry[1] > now:
+                    cached[ip] = entry[0]
+        return cached
+
+    def _store(self, results):
+        now = time.time()
+        with self.lock:
+            for ip, reachable in results.items():
+                # 探测被提前结束的IP（结果为None）不缓存
+                if reachable is not None:
+                    ttl = self.ttl if reachable else self.negative_ttl
+                    self.cache[ip] = (reachable, now + ttl)
+
+    def _probe(self, ips, first_only):
+        if self.probe == 'icmp':
+            return self._probe_icmp(ips, first_only)
+        return self._probe_tcp(ips, first_only)
+
+    def _probe_tcp(self, ips, first_only):
+        results = {}
+        socks = {}
+        poller = select.poll()
+        for ip in ips:
+            try:
+                family, socktype, proto, _, addr = socket.getaddrinfo(
+                    ip, self.port, 0, socket.SOCK_STREAM)[0]
+                sock = socket.socket(family, socktype, proto)
+            except socket.error:
+                results[ip] = False
+                continue
+            sock.setblocking(0)
+            err = sock.connect_ex(addr)
+            if err not in (0, errno.EINPROGRESS):
+                sock.close()
+                results[ip] = False
+                continue
+            socks[sock.fileno()] = (ip, sock)
+            poller.register(sock, select.POLLOUT)
+
+        deadline = time.time() + self.timeout
+        # 有IP应答后提前结束时，其余IP的结果未知（None），不能缓存为不可达
+        stopped_early = False
+        try:
+            while socks:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+                try:
+                    events = poller.poll(int(wait * 1000 + 0.5))
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+                for fd, _ in events:
+                    ip, sock = socks.pop(fd)
+                    poller.unregister(fd)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    sock.close()
+                    results[ip] = err == 0
+                    if err == 0 and first_only:
+                        stopped_early = True
+                        return results
+        finally:
+            for ip, sock in socks.values():
+                sock.close()
+                results.setdefault(ip, None if stopped_early else False)
+        return results
+
+    def _probe_icmp(self, ips, first_only):
+        results = {}
+        loop = CmdLoop()
+        commands = {}
+        for ip in ips:
+            cmd = "ping -c 1 -W %d -q %s" % (max(int(self.timeout), 1), ip)
+            commands[ip] = loop.spawn(Command(cmd, timeout=self.timeout + 1))
+
+        def answered():
+            return any(c.returncode == 0 for c in commands.values())
+
+        loop.run(until=answered if first_only else None)
+        for ip, command in commands.items():
+            if command.done():
+                results[ip] = command.returncode == 0
+            else:
+                command.kill(signal.SIGKILL)
+                results[ip] = None
+        loop.run()
+        return results
+
+
+_reachability = None
+_reachability_lock = threading.Lock()
+
+
+def get_reachability():
+    """Return the process-wide reachability cache."""
+
+    global _reachability
+    with _reachability_lock:
+        if _reachability is None:
+            _reachability = Reachability()
+    return _reachability
+
+
+def get_available_ip(ips):
+    """Return an available IP in ips, or None if all IPs are unavailable."""
+
+    return get_reachability().first_reachable(ips)
+
+
+# 命令结果缓存的默认有效期（秒）和最大条目数
+CMD_CACHE_TTL = 60
+CMD_CACHE_SIZE = 256
+
+
+class CmdCache(object):
+    """A size-bounded LRU cache of the results of idempotent commands,
+    keyed by (host, cmd). Only the results of succeeded commands are cached.
+    """
+
+    def __init__(self, size=CMD_CACHE_SIZE, ttl=CMD_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (host, cmd) -> (result, expire time)
+        self.entries = collections.OrderedDict()
+
+    def get(self, host, cmd):
+        key = (host, cmd)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                return None
+            # 重新插入以更新LRU顺序
+            self.entries[key] = entry
+            return entry[0]
+
+    def put(self, host, cmd, result, ttl=None):
+        if result[0] != 0:
+            return
+        expire = time.time() + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.entries.pop((host, cmd), None)
+            self.entries[(host, cmd)] = (result, expire)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, host=None, cmd=None):
+        """Drop the entries that match host and cmd, None matches any."""
+
+        with self.lock:
+            for key in self.entries.keys():
+                if (host is None or key[0] == host) \
+                        and (cmd is None or key[1] == cmd):
+                    del self.entries[key]
+
+    def call(self, host, cmd, func, ttl=None):
+        result = self.get(host, cmd)
+        if result is None:
+            result = func()
+            self.put(host, cmd, result, ttl)
+        return result
+
+
+_cmd_cache = CmdCache()
+
+
+def cached_sh(cmd, ttl=None):
+    """The same as sh, but a succeeded result is reused for ttl seconds
+    (CMD_CACHE_TTL by default). Only use it for idempotent probe commands.
+    """
+
+    return _cmd_cache.call("", cmd, lambda: sh(cmd), ttl)
+
+
+def cached_ssh(host, cmd, ttl=None):
+    """The cached version of ssh, see cached_sh."""
+
+    return _cmd_cache.call(host, cmd, lambda: ssh(host, cmd), ttl)
+
+
+def cached_ssh2(host_ips, cmd, ttl=None):
+    """The cached version of ssh2, see cached_sh."""
+
+    return _cmd_cache.call(",".join(host_ips), cmd,
+                           lambda: ssh2(host_ips, cmd), ttl)
+
+
+def invalidate_cache(host=None, cmd=None):
+    """Drop the cached results of cmd on host, None matches any, "" is the
+    local host.
+    """
+
+    _cmd_cache.invalidate(host, cmd)
+
+
+# 非阻塞接口的全局并发数与单个主机的并发数限制
+ASYNC_MAX_RUNNING = 1000
+ASYNC_MAX_PER_HOST = SSH_MAX_SESSIONS_PER_HOST
+
+
+class AsyncShell(object):
+    """Non-blocking variants of sh, ssh and scp, all driven by one CmdLoop.
+
+    ash, assh and ascp return a Command immediately, the commands run
+    concurrently when gather or as_completed drives the loop, so a single
+    thread can handle thousands of remote operations. At most max_running
+    commands run at the same time, and at most max_per_host commands per
+    host.
+
+    The ssh commands share the pooled master connections, the first command
+    to a host becomes its master.
+    """
+
+    def __init__(self, max_running=ASYNC_MAX_RUNNING,
+                 max_per_host=ASYNC_MAX_PER_HOST):
+        self.loop = CmdLoop(max_running)
+        self.max_per_host = max_per_host
+        self.host_running = collections.defaultdict(int)
+        self.host_pending = collections.defaultdict(collections.deque)
+
+    def ash(self, cmd, timeout=None, on_exit=None):
+        """Start a shell command, see sh."""
+
+        return self.loop.spawn(Command(cmd, timeout=timeout, on_exit=on_exit))
+
+    def assh(self, host, cmd, timeout=None, user="", on_exit=None):
+        """Start a command over ssh on host, see ssh3."""
+
+        extra_opts = ""
+        if SSH_MULTIPLEX:
+            extra_opts = get_ssh_pool().control_opts(user, host)
+        ssh_cmd = gen_ssh_cmd(user, host, cmd, extra_opts)
+        if ssh_cmd is None:
+            command = Command(cmd)
+            command.stderr_chunks.append(
+                """cmd:%s can not contain both " and '""" % cmd)
+            command.returncode = 1
+            return command
+        return self._spawn_on_host(host, Command(ssh_cmd, timeout=timeout,
+                                                 on_exit=on_exit))
+
+    def ascp(self, file_or_dir, dest_host, dest_path, user="root",
+             timeout=None, on_exit=None):
+        """Start copying a file or directory to dest_host, see scp."""
+
+        scp_cmd = gen_base_scp_cmd("", file_or_dir, dest_host, dest_path,
+                                   dest_user=user)
+        return self._spawn_on_host(dest_host, Command(scp_cmd, timeout=timeout,
+                                                      on_exit=on_exit))
+
+    def as_completed(self, commands):
+        """Run the loop and yield the commands in the order they finish."""
+
+        remaining = set(commands)
+        while remaining:
+            for command in [c for c in remaining if c.done()]:
+                remaining.discard(command)
+                yield command
+            if remaining:
+                if self.loop.idle():
+                    return
+                self.loop.run_once()
+
+    def gather(self, commands):
+        """Run the loop until all the commands finish.
+
+        Returns:
+            A list of (returncode, stdout, stderr), in the order of commands.
+        """
+
+        for _ in self.as_completed(commands):
+            pass
+        return [command.result() for command in commands]
+
+    def cancel(self, command):
+        """Kill a running command, or drop it if it has not been started."""
+
+        if command.done():
+            return
+        if command.process is not None:
+            command.kill(signal.SIGKILL)
+            return
+        on_exit = command.on_exit
+        if command in self.loop.pending:
+            self.loop.pending.remove(command)
+        else:
+            for queue in self.host_pending.values():
+                if command in queue:
+                    queue.remove(command)
+                    # 还未占用主机的名额，不能调用host_done释放名额
+                    on_exit = command.on_exit.user_on_exit
+        command.returncode = -signal.SIGKILL
+        command.end_time = time.time()
+        if on_exit is not None:
+            on_exit(command)
+
+    def _spawn_on_host(self, host, command):
+        on_exit = command.on_exit
+
+        def host_done(command):
+            self.host_running[host] -= 1
+            pending = self.host_pending[host]
+            if pending:
+                self.host_running[host] += 1
+                self.loop.spawn(pending.popleft())
+            if on_exit is not None:
+                on_exit(command)
+
+        host_done.user_on_exit = on_exit
+        command.on_exit = host_done
+        if self.host_running[host] < self.max_per_host:
+            self.host_running[host] += 1
+            self.loop.spawn(command)
+        else:
+            self.host_pending[host].append(command)
+        return command
+
+
+_async_shell = None
+
+
+def get_async_shell():
+    """Return the AsyncShell shared by ash, assh, ascp and gather."""
+
+    global _async_shell
+    if _async_shell is None:
+        _async_shell = AsyncShell()
+    return _async_shell
+
+
+def ash(cmd, timeout=None, on_exit=None):
+    return get_async_shell().ash(cmd, timeout=timeout, on_exit=on_exit)
+
+
+def assh(host, cmd, timeout=None, user="", on_exit=None):
+    return get_async_shell().assh(host, cmd, timeout=timeout, user=user,
+                                  on_exit=on_exit)
+
+
+def ascp(file_or_dir, dest_host, dest_path, user="root", timeout=None,
+         on_exit=None):
+    return get_async_shell().ascp(file_or_dir, dest_host, dest_path,
+                                  user=user, timeout=timeout, on_exit=on_exit)
+
+
+def gather(commands):
+    return get_async_shell().gather(commands)
+
+
+def as_completed(commands):
+    return get_async_shell().as_completed(commands)
@@ -1,19 +1,67 @@
 # encoding=utf8
 
+import atexit
+import functools
 import os
+import random
 import re
 import multiprocessing
+import multiprocessing.pool
+import Queue
+import threading
 import traceback
 import json
 import socket
 import sys
 import time
+import iptools
+import metrics
+import mountinfo
+import netif
+import proctable
 import shell
 
 
 AUTO_MOUNT_OPEN = 1
 AUTO_MOUNT_CLOSE = 0
 LSOF_TIME_OUT = 15
+# master可能发生切换，其查询结果只缓存较短的时间
+MASTER_CACHE_TTL = 10
+# 检查所有卷是否被占用的总超时时间（秒）
+VOLUME_CHECK_TIMEOUT = 60
+# 重试的退避策略：首次间隔、最大间隔（秒）和随机抖动的比例
+RETRY_BASE_INTERVAL = 0.1
+RETRY_MAX_INTERVAL = 3
+RETRY_JITTER = 0.2
+# 等待设备出现在sysfs中的轮询间隔（秒）
+DEV_POLL_INTERVAL = 0.05
+# 参数查询结果的缓存时间（秒），更新参数时对应的缓存会被清除
+PARAM_CACHE_TTL = 5
+# 同时部署工具的最大节点数
+TOOLS_COPY_CONCURRENCY = 32
+# 排除一些无用的其比较大的文件
+TOOLS_EXCLUDES = [r"*jnl_devformat", r"*obs_addldisk", r"*obs_format"]
+# 流式解压安装包时xz的线程数，0表示每个CPU一个线程，None表示由tar单线程解压
+XZ_THREADS = None
+
+
+# 常驻进程池/线程池的最大工作者数量，线程只用于等待I/O的任务，可以多得多
+PARALLEL_POOL_SIZE = 100
+THREAD_POOL_SIZE = 1000
+# 是否在多次调用间复用进程池。fork出的工作者只持有创建进程池时模块全局变量
+# 的快照，之后父进程中的修改对它们不可见，所以默认每次调用新建进程池；
+# 线程共享内存，线程池总是复用
+REUSE_PROCESS_POOL = False
+# 类型 -> 当前的_Executor
+_executors = {}
+# 所有未关闭的_Executor，包括已被替换但仍在使用的
+_all_executors = []
+_executors_lock = threading.Lock()
+# (section, name) -> (current, expire time)
+_param_cache = {}
+# MGR是否支持批量的get_param请求，None表示还未尝试
+_param_batch_get_supported = None
+_param_cache_lock = threading.Lock()
 
 
 def _warp_fun(*args, **kwargs):
@@ -31,37 +79,481 @@ def _warp_fun(*args, **kwargs):
     return index, result
 
 
-def parallel_execute(func, args=[], kwargs={}):
+def _warp_task(task):
+    """The single-argument form of _warp_fun used by imap."""
+
+    index, func, arg, kwargs = task
+    return _warp_fun(index, func, [arg], **kwargs)
+
+
+def io_bound(func):
+    """Mark a function as I/O bound (e.g. it mostly waits on subprocesses
+    or the network), so that parallel_execute runs it on the thread pool.
+    """
+
+    func.io_bound = True
+    return func
+
+
+def _select_executor(func, executor, io_bound_hint):
+    """The executor kind for func: the explicit executor if given,
+    otherwise 'thread' for I/O bound functions and 'process' for the others.
+    """
+
+    if executor is not None:
+        return executor
+    if io_bound_hint or getattr(func, 'io_bound', False):
+        return 'thread'
+    return 'process'
+
+
+class _Executor(object):
+    """One generation of a long-lived worker pool.
+
+    A generation is replaced by a larger one when more workers are needed,
+    or by a new one when its workers are stuck on timed out tasks. The
+    replaced generation is retired: it takes no new users, and it is closed
+    (terminated if stuck) only after all of its users have released it, so
+    a pool is never closed while a caller is still submitting to it.
+    """
+
+    def __init__(self, kind, size):
+        self.kind = kind
+        self.size = size
+        if kind == 'process':
+            self.pool = multiprocessing.Pool(size)
+        else:
+            self.pool = multiprocessing.pool.ThreadPool(size)
+        self.users = 0
+        self.retired = False
+        self.stuck = False
+
+    def close(self):
+        if self.stuck and self.kind == 'process':
+            self.pool.terminate()
+        else:
+            # 已提交的任务仍会执行完，工作者随后退出；线程无法被强制结束
+            self.pool.close()
+
+
+def _acquire_executor(kind, size=None, reuse=None):
+    """Take a reference on the current generation of the pool of the kind,
+    which must be given back by _release_executor.
+
+    Args:
+        kind: 'process' for a multiprocessing.Pool, 'thread' for a
+            ThreadPool.
+        size: The number of workers needed, at most PARALLEL_POOL_SIZE
+            (THREAD_POOL_SIZE for threads). If the current pool is smaller,
+            a larger one replaces it.
+        reuse: If False, a private pool is created, which is closed when it
+            is released. If None, the thread pool is reused and the process
+            pool is reused only if REUSE_PROCESS_POOL is True.
+
+    Returns:
+        An _Executor.
+    """
+
+    if kind not in ('process', 'thread'):
+        raise Exception("Unknown executor kind:%s" % kind)
+    max_size = PARALLEL_POOL_SIZE if kind == 'process' else THREAD_POOL_SIZE
+    size = min(size or max_size, max_size)
+    if reuse is None:
+        reuse = kind == 'thread' or REUSE_PROCESS_POOL
+    with _executors_lock:
+        if not reuse:
+            # 和调用时的全局变量一致的新进程池，释放后即关闭
+            executor = _Executor(kind, size)
+            executor.retired = True
+            executor.users = 1
+            _all_executors.append(executor)
+            return executor
+        executor = _executors.get(kind)
+        if executor is None or executor.size < size:
+            if executor is not None:
+                # 成倍扩容，避免规模逐次增加时反复重建
+                size = min(max(size, executor.size * 2), max_size)
+                _retire_executor(executor)
+            executor = _executors[kind] = _Executor(kind, size)
+            _all_executors.append(executor)
+        executor.users += 1
+        return executor
+
+
+def _release_executor(executor):
+    with _executors_lock:
+        executor.users -= 1
+        if executor.retired and executor.users == 0:
+            _all_executors.remove(executor)
+            executor.close()
+
+
+def _retire_executor(executor):
+    """Must be called with _executors_lock held."""
+
+    if _executors.get(executor.kind) is executor:
+        del _executors[executor.kind]
+    executor.retired = True
+    if executor.users == 0 and executor in _all_executors:
+        _all_executors.remove(executor)
+        executor.close()
+
+
+def get_executor(kind='process', size=None):
+    """Return the long-lived worker pool of the kind, which is created on
+    first use and reused by later calls. See _acquire_executor for the
+    arguments.
+
+    The returned pool is never closed before the process exits, even if a
+    larger pool replaces it. The workers of a process pool see the module
+    globals as they were when the pool was created, later changes made by
+    the caller are not visible to them.
+
+    Returns:
+        A multiprocessing.Pool or multiprocessing.pool.ThreadPool.
+    """
+
+    return _acquire_executor(kind, size, reuse=True).pool
+
+
+def shutdown_executors():
+    """Terminate the long-lived worker pools."""
+
+    with _executors_lock:
+        for executor in _all_executors:
+            executor.pool.terminate()
+        del _all_executors[:]
+        _executors.clear()
+
+
+atexit.register(shutdown_executors)
+
+
+def _warp_chunk(tasks, func, kwargs):
+    """Call func on each argument of a chunk of tasks, the errors are
+    returned instead of printed.
+
+    Args:
+        tasks: A list of (index, argument).
+
+    Returns:
+        A list of (index, True, result) if succeed, otherwise (index, False,
+        the traceback of the exception).
+    """
+
+    results = []
+    for index, arg in tasks:
+        try:
+            results.append((index, True, func(arg, **kwargs)))
+        except:
+            results.append((index, False, traceback.format_exc()))
+    return results
+
+
+def _discard_executor(executor):
+    """Retire a pool whose workers are stuck on timed out tasks, the next
+    _acquire_executor call creates a new one. The pool is terminated (or
+    closed for threads) once its last user releases it.
+    """
+
+    with _executors_lock:
+        executor.stuck = True
+        _retire_executor(executor)
+
+
+# 自适应并发：延迟超过观测到的最小延迟的该倍数时视为过载
+ADAPTIVE_LATENCY_FACTOR = 3.0
+ADAPTIVE_INITIAL_LIMIT = 4
+# 轮询失败任务（无法序列化参数或结果）的间隔（秒）
+RESULT_POLL_INTERVAL = 0.5
+
+
+class AdaptiveLimit(object):
+    """A concurrency limit adjusted by AIMD from the observed latency and
+    errors.
+
+    The limit starts small and doubles every round trip (slow start) until
+    the first sign of overload, then grows by one per round trip. An error,
+    a timeout, or a latency above latency_factor times the lowest latency
+    seen halves it, at most once per round trip.
+    """
+
+    def __init__(self, maximum, initial=ADAPTIVE_INITIAL_LIMIT, minimum=1,
+                 latency_factor=ADAPTIVE_LATENCY_FACTOR):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.latency_factor = latency_factor
+        self.limit = float(max(min(initial, maximum), minimum))
+        self.threshold = float(maximum)
+        self.min_latency = None
+        # 距离上次减小后完成的任务数，不足一个窗口时不再减小
+        self.since_decrease = 0
+
+    def current(self):
+        return int(self.limit)
+
+    def on_result(self, latency, ok):
+        self.since_decrease += 1
+        if ok and (self.min_latency is None or latency < self.min_latency):
+            self.min_latency = latency
+        overloaded = not ok or (
+            self.min_latency is not None and
+            latency > self.min_latency * self.latency_factor)
+        if overloaded:
+            if self.since_decrease >= self.limit:
+                self.threshold = max(self.limit / 2, self.minimum)
+                self.limit = self.threshold
+                self.since_decrease = 0
+        elif self.limit < self.threshold:
+            self.limit = min(self.limit + 1, self.maximum)
+        else:
+            self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+
+def _auto_chunksize(executor, tasks, workers):
+    """Like multiprocessing.Pool.map: about 4 chunks per worker. Threads
+    share memory and pay no IPC, so their tasks are not chunked.
+    """
+
+    if executor != 'process':
+        return 1
+    chunksize, extra = divmod(tasks, workers * 4)
+    return chunksize + 1 if extra else max(chunksize, 1)
+
+
+def iparallel_execute(func, args=[], kwargs={}, executor=None,
+                      timeout=None, io_bound=None, chunksize=None,
+                      adaptive=False):
+    """Execute the function parallelly, the results are yielded as soon as
+    the tasks finish.
+
+    Args:
+        func, args, kwargs, executor, io_bound: See parallel_execute.
+        timeout: If not None, a task that does not finish within timeout
+            seconds after it is handed to a worker is reported as failed,
+            and its late result is discarded. Workers stuck on such tasks
+            are recycled.
+        chunksize: The number of tasks sent to a worker at once, which cuts
+            the IPC cost of small tasks. If None, it is chosen from the
+            number of tasks and workers like Pool.map does. The timeout of
+            a chunk is timeout multiplied by its size.
+        adaptive: If True, the number of chunks in flight is adjusted by an
+            AdaptiveLimit instead of being the number of workers, so
+            expensive tasks do not overwhelm the remote side.
+
+    Returns:
+        A generator of (index in args, result, error). error is None if the
+        task succeed, otherwise it is the error message and result is None.
+        If the caller stops iterating, the remaining tasks are cancelled.
+    """
+
+    if len(args) == 0:
+        return
+    kind = _select_executor(func, executor, io_bound)
+    executor = _acquire_executor(kind, len(args))
+    workers = executor.size
+    if chunksize is None:
+        chunksize = _auto_chunksize(kind, len(args), workers)
+    tasks = list(enumerate(args))
+    chunks = [tasks[i:i + chunksize] for i in range(0, len(tasks), chunksize)]
+    limit = AdaptiveLimit(workers) if adaptive else None
+    done = Queue.Queue()
+    # chunk序号 -> (提交时间, AsyncResult)
+    in_flight = {}
+    # 已超时但仍占用工作者的chunk
+    stragglers = set()
+    next_chunk = 0
+
+    def chunk_timeout(chunk_id):
+        return timeout * len(chunks[chunk_id])
+
+    def chunk_error(chunk_id, error):
+        submitted = in_flight.pop(chunk_id)[0]
+        if limit is not None:
+            limit.on_result(time.time() - submitted, False)
+        return [(index, None, error) for index, _ in chunks[chunk_id]]
+
+    try:
+        while next_chunk < len(chunks) or in_flight:
+            # 超时的chunk只占用工作者，不计入自适应的并发数，否则并发数
+            # 降到超时的chunk数以下时将无法提交新的chunk
+            max_in_flight = workers if limit is None \
+                else min(limit.current(), workers)
+            while next_chunk < len(chunks) \
+                    and len(in_flight) < max_in_flight \
+                    and len(in_flight) + len(stragglers) < workers:
+                chunk_id = next_chunk
+                result = executor.pool.apply_async(
+                    _warp_chunk, args=[chunks[chunk_id], func, kwargs],
+                    callback=lambda r, c=chunk_id: done.put((c, r)))
+                in_flight[chunk_id] = (time.time(), result)
+                next_chunk += 1
+            # 只有成功的任务会调用callback，无法序列化参数或结果的任务
+            # 只能通过轮询AsyncResult发现
+            wait = RESULT_POLL_INTERVAL
+            if timeout is not None:
+                wait = min([wait] + [submitted + chunk_timeout(c)
+                                     for c, (submitted, _) in
+                                     in_flight.items()]) - time.time()
+            try:
+                chunk_id, results = done.get(timeout=max(wait, 0))
+            except Queue.Empty:
+                for c, (submitted, result) in in_flight.items():
+                    if result.ready() and not result.successful():
+                        try:
+                            result.get()
+                        except Exception:
+                            error = traceback.format_exc()
+                        for r in chunk_error(c, error):
+                            yield r
+                if timeout is None:
+                    continue
+                now = time.time()
+                for c, (submitted, _) in in_flight.items():
+                    if now - submitted < chunk_timeout(c):
+                        continue
+                    stragglers.add(c)
+                    for r in chunk_error(
+                            c, "Task timeout after %s seconds." % timeout):
+                        yield r
+                if len(stragglers) >= workers:
+                    _discard_executor(executor)
+                    _release_executor(executor)
+                    executor = _acquire_executor(kind, len(args))
+                    workers = executor.size
+                    stragglers = set()
+                continue
+            if chunk_id not in in_flight:
+                # 超时的chunk，包括已丢弃的进程池中的，其结果被忽略
+                stragglers.discard(chunk_id)
+                continue
+            submitted = in_flight.pop(chunk_id)[0]
+            if limit is not None:
+                limit.on_result(time.time() - submitted,
+                                all(ok for _, ok, _ in results))
+            for index, ok, value in results:
+                if ok:
+                    yield index, value, None
+                else:
+                    yield index, None, value
+    finally:
+        if in_flight or stragglers:
+            _discard_executor(executor)
+        _release_executor(executor)
+
+
+class ParallelReport(object):
+    """The summary of a parallel execution.
+
+    Attributes:
+        results: A dict that maps the index in args to the result of the
+            succeeded tasks.
+        errors: A dict that maps the index in args to the error message of
+            the failed tasks.
+    """
+
+    def __init__(self):
+        self.results = {}
+        self.errors = {}
+
+    def ok(self):
+        return len(self.errors) == 0
+
+    def __repr__(self):
+        return "ParallelReport(succeeded=%d, failed=%d)" % (
+            len(self.results), len(self.errors))
+
+
+def parallel_execute_report(func, args=[], kwargs={}, executor=None,
+                            timeout=None, callback=None, io_bound=None,
+                            chunksize=None, adaptive=False):
+    """Execute the function parallelly, a failed task does not discard the
+    results of the others.
+
+    Args:
+        func, args, kwargs, executor, timeout, io_bound, chunksize,
+        adaptive: See iparallel_execute.
+        callback: If not None, callback(index, result, error) is called as
+            soon as a task finishes.
+
+    Returns:
+        A ParallelReport.
+    """
+
+    report = ParallelReport()
+    for index, result, error in iparallel_execute(func, args, kwargs,
+                                                  executor, timeout, io_bound,
+                                                  chunksize, adaptive):
+        if error is None:
+            report.results[index] = result
+        else:
+            report.errors[index] = error
+        if callback is not None:
+            callback(index, result, error)
+    return report
+
+
+def parallel_execute(func, args=[], kwargs={}, executor=None, io_bound=None):
     """Execute the function parallelly.
     
     Args:
         func: the function that will be executed.
         args: a list, each element will be passed as an argument to the function.
         kwargs: a dict which will be passed to the function.
+        executor: 'process' or 'thread', the kind of the pool that
+            executes the function. If None, it is chosen by io_bound. The
+            thread pool is long-lived (see get_executor); a process pool is
+            forked for each call, so the workers see the current globals,
+            unless REUSE_PROCESS_POOL is True.
+        io_bound: If True, or if func is decorated by io_bound, the tasks
+            run on the thread pool: no process is forked and nothing is
+            pickled, which suits the tasks that mostly wait on subprocesses
+            or the network. Otherwise they run on the process pool.
 
     Returns:
         a list, each element in the list is a result of a function.
    """
 
-    min_num = min((len(args), 100))
-    pool = multiprocessing.Pool(min_num)
-    results = []
-    task_list = []
-    i = 0
-    for a in args:
-        t = pool.apply_async(_warp_fun, args=[i, func, [a]], kwds=kwargs)
-        task_list.append(t)
-        i += 1
-    pool.close()
-    pool.join()
-    for t in task_list:
-        results.append(t.get())
+    report = parallel_execute_report(func, args, kwargs, executor,
+                                     io_bound=io_bound)
     # Check error.
-    for r in results:
-        if r is None:
-            raise Exception('Some error happens, see detail message in log.')
-    results = [r[1] for r in results]
-    return results
+    if not report.ok():
+        for index in sorted(report.errors):
+            sys.stderr.write(report.errors[index])
+        raise Exception('Some error happens, see detail message in log.')
+    return [report.results[i] for i in range(len(args))]
+
+
+def parallel_map(func, args=[], kwargs={}, executor=None, ordered=True,
+                 io_bound=None):
+    """Like parallel_execute, but the results are yielded one by one.
+
+    Args:
+        ordered: If True, the results are yielded in the order of args,
+            otherwise as soon as they are ready.
+
+    Returns:
+        A generator of (index in args, result). If the function raised an
+        exception, an exception is raised when its result is reached.
+    """
+
+    if len(args) == 0:
+        return
+    executor = _acquire_executor(_select_executor(func, executor, io_bound),
+                                 len(args))
+    try:
+        tasks = [(i, func, a, kwargs) for i, a in enumerate(args)]
+        if ordered:
+            results = executor.pool.imap(_warp_task, tasks)
+        else:
+            results = executor.pool.imap_unordered(_warp_task, tasks)
+        for r in results:
+            if r is None:
+                raise Exception(
+                    'Some error happens, see detail message in log.')
+            yield r
+    finally:
+        _release_executor(executor)
 
 
 def parse_string_to_dic(input_str, sep1='#', sep2=':'):
@@ -90,6 +582,7 @@ be reached."""
     return "ping -i 0.2 -w 2 -W 2 -c 5 -q %s" % ip
 
 
+@io_bound
 def check_ip_avaliable(ip):
     """check ip if avaliable"""
 
@@ -129,13 +622,45 @@ def get_files_of_dir(dir_path):
     return files
 
 
-def gen_tar_command(original_file_path):
-    return 'tar xvf %s' % original_file_path
+def gen_tar_command(original_file_path, dest_dir=None):
+    if dest_dir is None:
+        return 'tar xvf %s' % original_file_path
+    return 'tar xvf %s -C %s' % (original_file_path, dest_dir)
+
+
+def gen_stream_untar_command(package_path, dest_dir, xz_threads=XZ_THREADS):
+    """Generate the remote command that unpacks the package read from the
+    standard input into dest_dir.
+
+    Args:
+        xz_threads: The number of threads of xz to decompress a .xz package
+            (0 means one per CPU, an xz without -T uses one thread), None
+            (the default) to let tar decompress it.
+    """
+
+    if package_path.endswith('.xz') and xz_threads is not None:
+        # 旧版本的xz不支持-T，此时单线程解压；
+        # 管道中xz失败时tar可能正常退出，需要pipefail才能发现
+        return 'mkdir -p %s && set -o pipefail && ' \
+               'if xz --help 2>&1 | grep -q -- --threads; ' \
+               'then xz -dc -T%d; else xz -dc; fi | tar -xf - -C %s' % (
+                   dest_dir, xz_threads, dest_dir)
+    flag = '-xJf' if package_path.endswith('.xz') else '-xf'
+    return 'mkdir -p %s && tar %s - -C %s' % (dest_dir, flag, dest_dir)
 
 
-def copy_package_to_remote(host_ips, dest_path):
+def copy_package_to_remote(host_ips, dest_path, stream=False,
+                           xz_threads=XZ_THREADS):
     """Copy the ParaStor package to remote host.
 
+    Args:
+        stream: If True, the package is piped over ssh into tar on the
+            remote host, so it is unpacked while being transferred and is
+            never stored on the remote disk. Otherwise it is copied to
+            dest_path and unpacked there.
+        xz_threads: See gen_stream_untar_command, only used if stream is
+            True.
+
     Returns:
         If failed, an exception will be raised.
     """
@@ -146,7 +671,24 @@ def copy_package_to_remote(host_ips, dest_path):
         packages = get_files_of_dir(package_dir)
         # Just choose the first package file in the package directory.
         # In fact, there should be only one package file in the directory.
-        package_path = packages[0]
+        package_path = os.path.join(package_dir, packages[0])
+
+        if stream:
+            ip = shell.get_available_ip(host_ips)
+            if ip is None:
+                raise Exception("Copy package from %s to %s:%s failed, no "
+                                "available ip." % (package_path,
+                                                   ' '.join(host_ips),
+                                                   dest_path))
+            untar_command = gen_stream_untar_command(package_path, dest_path,
+                                                     xz_threads)
+            rc, stdout, stderr = shell.ssh_with_stdin(ip, untar_command,
+                                                      package_path)
+            if rc != 0:
+                raise Exception('Stream the package %s to %s:%s failed: %s '
+                                '\n %s' % (package_path, ip, dest_path,
+                                            stdout, stderr))
+            return
 
         # Scp package to remote host.
         rc = shell.scp2(package_path, host_ips, dest_path)
@@ -155,8 +697,9 @@ def copy_package_to_remote(host_ips, dest_path):
                 package_path, ' '.join(host_ips), dest_path))
         # Untar the package
         tar_command = gen_tar_command(dest_path + "/"
-                                      + package_path.split('/')[-1])
-        (rc, stdout, stderr) = shell.ssh2(tar_command, host_ips)
+                                      + package_path.split('/')[-1],
+                                      dest_path)
+        (rc, stdout, stderr) = shell.ssh2(host_ips, tar_command)
         if rc != 0:
             raise Exception('Untar the package failed: %s \n %s' % (stdout,
                                                                     stderr))
@@ -187,6 +730,16 @@ def mkdir_remote(host_ips, dir):
             dir, ' '.join(host_ips), stdout, stderr))
 
 
+def _tools_layout(dest_path):
+    """The (source directory, destination directory) pairs of the tools."""
+
+    cli_parent_dir = get_cli_dir()
+    return [('%s/cli' % cli_parent_dir, dest_path),
+            ('%s/tools/hardware' % cli_parent_dir, '%s/tools' % dest_path),
+            ('%s/conf/hardware_conf' % cli_parent_dir, '%s/conf' % dest_path),
+            ]
+
+
 def copy_tools_to_remote(host_ips, dest_path):
     """Copy the ParaStor CLI and tools directories to remote host.
 
@@ -197,26 +750,68 @@ def copy_tools_to_remote(host_ips, dest_path):
         If failed, an exception will be raised.
     """
 
-    mkdir_remote(host_ips, dest_path)
-    dest_dirs = [dest_path, '%s/tools' % dest_path, '%s/conf' % dest_path]
-    for dest_dir in dest_dirs:
-        mkdir_remote(host_ips, dest_dir)
+    errors = copy_tools_to_hosts([host_ips], dest_path)
+    if errors:
+        raise Exception(errors.values()[0])
 
-    cli_parent_dir = get_cli_dir()
-    src_dirs = ['%s/cli' % cli_parent_dir,
-                '%s/tools/hardware' % cli_parent_dir,
-                '%s/conf/hardware_conf' % cli_parent_dir,
-                ]
-    # 排除一些无用的其比较大的文件
-    excludes = [r"*jnl_devformat", r"*obs_addldisk", r"*obs_format"]
-
-    for src_dir, dest_dir in zip(src_dirs, dest_dirs):
-        log.info("src %s, dest %s" % (src_dir, dest_dir))
-        rc, stdout, stderr = shell.rsync2(src_dir, host_ips, dest_dir, excludes)
-        if rc != 0:
-            raise Exception(
-                "Copy directory from %s to %s:%s failed, stdout: %s, stderr: %s " % (
-                    src_dir, ' '.join(host_ips), dest_dir, stdout, stderr))
+
+def copy_tools_to_hosts(hosts, dest_path, concurrency=TOOLS_COPY_CONCURRENCY):
+    """Copy the ParaStor CLI and tools directories to many remote hosts.
+
+    All the destination directories of a host are created by one remote
+    command, then the directories are transferred concurrently over the
+    pooled ssh connection of the host.
+
+    Args:
+        hosts: The IP lists of the hosts, like [['10.0.0.1', '20.0.0.1'],
+            ['10.0.0.2', '20.0.0.2']], each host is reached through any of
+            its available IPs.
+        dest_path: The destination directory on each host.
+        concurrency: The maximum number of hosts copied at the same time.
+
+    Returns:
+        A dict that maps ' '.join(host_ips) of each failed host to its error
+        message, empty if all hosts succeed.
+    """
+
+    layout = _tools_layout(dest_path)
+    errors = {}
+    # 一次并发探测所有节点的IP，每个节点取第一个可达的IP
+    reachable = set(shell.get_reachability().reachable_ips(
+        [ip for host_ips in hosts for ip in host_ips]))
+    names = {}
+    for host_ips in hosts:
+        name = ' '.join(host_ips)
+        ips = [ip for ip in host_ips if ip in reachable]
+        if not ips:
+            errors[name] = "no available ip in %s" % name
+        else:
+            names[ips[0]] = name
+
+    dest_dirs = ' '.join(dest_dir for _, dest_dir in layout)
+    for ip, result in shell.ifanout(list(names), 'mkdir -p %s' % dest_dirs,
+                                    concurrency):
+        if result.rc != 0:
+            errors[names.pop(ip)] = "Make directory %s on %s failed:%s,%s" % (
+                dest_dirs, ip, result.stdout, result.stderr)
+
+    tasks = [(ip, src_dir, dest_dir) for ip in names
+             for src_dir, dest_dir in layout]
+    cmds = []
+    for ip, src_dir, dest_dir in tasks:
+        log.info("src %s, dest %s:%s" % (src_dir, ip, dest_dir))
+        ssh_opts = shell.get_ssh_pool().control_opts("", ip) \
+            if shell.SSH_MULTIPLEX else ""
+        cmds.append(shell.gen_transfer_cmd(
+            src_dir, ip, dest_dir, resume=False, checksum=False,
+            exclude_pattens=TOOLS_EXCLUDES, ssh_opts=ssh_opts))
+    results = shell.sh_all(cmds, max_running=concurrency * len(layout))
+    for (ip, src_dir, dest_dir), (rc, stdout, stderr) in zip(tasks, results):
+        if rc != 0 and names[ip] not in errors:
+            errors[names[ip]] = "Copy directory from %s to %s:%s failed, " \
+                                "stdout: %s, stderr: %s " % (
+                                    src_dir, ip, dest_dir, stdout, stderr)
+    return errors
 
 
 def get_package_name():
@@ -253,7 +848,7 @@ def get_local_version():
     if not os.path.exists(settings.PARASTOR_CONF_LOCAL_NODE):
         return -1
     my_cmd = 'grep version %s ' % settings.PARASTOR_CONF_LOCAL_NODE
-    rc, stdout, stderr = shell.sh(my_cmd)
+    rc, stdout, stderr = shell.cached_sh(my_cmd)
     if rc != 0:
         return -1
     pattern = re.compile('\d+')
@@ -288,12 +883,11 @@ def parse_ip_list(ip_list_str):
         如果解析失败，返回None
     """
 
-    tmp = ip_list_str.split('#')
     mgr_nodes = []
-    for t in tmp:
-        ips = t.split(',')
+    for group in ip_list_str.split('#'):
+        ips = group.split(',')
         for ip in ips:
-            if not validator.is_valid_ip(ip):
+            if not iptools.is_valid_ip(ip):
                 return None
         mgr_nodes.append(ips)
     if len(mgr_nodes) == 0:
@@ -316,88 +910,73 @@ def log_cron():
 
 
 
-def get_local_ips():
-    """获取所有本地IP（只在Linux下使用，需要ifconifg命令支持）
-
-    Returns:
-        IP地址列表
+def _get_local_ips_by_cmd(cmd):
+    """Parse the IPv4 addresses from the output of ifconfig or ip addr, used
+    when the addresses can not be read through netlink.
     """
-    rc, stdout, stderr = shell.sh(
-        "ifconfig |grep 'inet ' |grep -v '127.0.0.1'")
+
+    rc, stdout, stderr = shell.cached_sh(cmd)
     if rc != 0:
         raise Exception('Cannot get local IP addresses.')
 
+    pattern = re.compile("[0-9]+.[0-9]+.[0-9]+.[0-9]+")
     lines = stdout.strip().split('\n')
     ret = []
     for line in lines:
-        # 以空格分隔
-        items = line.split(' ')
-        # 过滤掉所有空字符串
-        items = [x for x in items if x != '']
-        # 过滤掉所有不是以数字开头的字符串，剩下的全是IP地址
-        items = [re.search("[0-9]+.[0-9]+.[0-9]+.[0-9]+", x).group(0) for x in
-                 items if
-                 re.search("[0-9]+.[0-9]+.[0-9]+.[0-9]+", x) is not None]
-        ret.append(items[0])
+        # 取每行中第一个IP地址
+        match = pattern.search(line)
+        if match is not None:
+            ret.append(match.group(0))
 
     return ret
 
 
-def get_client_local_ips():
-    """获取所有本地IP（只在Linux下使用，需要ifconifg命令支持）
-    客户端精简OS(最小OS)不支持ifconfig命令，禁用函数中ifconfig命令。
+def _get_local_ips(include_virtual):
+    """Read the local IPv4 addresses except 127.0.0.1 through netlink."""
+
+    return [a.address for a in netif.get_addresses(4, include_virtual)
+            if a.address != '127.0.0.1']
+
+
+def get_local_ips():
+    """获取所有本地IP（只在Linux下使用，结果与ifconfig显示的一致）
 
     Returns:
         IP地址列表
     """
-    rc, stdout, stderr = shell.sh(
-        "ip addr |grep 'inet ' |grep -v '127.0.0.1'")
-    if rc != 0:
-        raise Exception('Cannot get local IP addresses.')
+    try:
+        return _get_local_ips(include_virtual=False)
+    except socket.error:
+        return _get_local_ips_by_cmd(
+            "ifconfig |grep 'inet ' |grep -v '127.0.0.1'")
 
-    lines = stdout.strip().split('\n')
-    ret = []
-    for line in lines:
-        # 以空格分隔
-        items = line.split(' ')
-        # 过滤掉所有空字符串
-        items = [x for x in items if x != '']
-        # 过滤掉所有不是以数字开头的字符串，剩下的全是IP地址
-        items = [re.search("[0-9]+.[0-9]+.[0-9]+.[0-9]+", x).group(0) for x in
-                 items if
-                 re.search("[0-9]+.[0-9]+.[0-9]+.[0-9]+", x) is not None]
-        ret.append(items[0])
 
-    return ret
+def get_client_local_ips():
+    """获取所有本地IP（只在Linux下使用）
+    客户端精简OS(最小OS)不支持ifconfig命令，通过netlink读取，不依赖任何命令。
+
+    Returns:
+        IP地址列表
+    """
+    try:
+        return _get_local_ips(include_virtual=True)
+    except socket.error:
+        return _get_local_ips_by_cmd(
+            "ip addr |grep 'inet ' |grep -v '127.0.0.1'")
 
 
 def get_local_ips_with_virtual_ip():
-    """获取所有本地IP（只在Linux下使用，需要ifconifg命令支持）
+    """获取所有本地IP，包括ifconfig看不到的虚拟IP（只在Linux下使用）
 
     Returns:
         IP地址列表
     """
 
-    rc, stdout, stderr = shell.sh(
-        "ip addr |grep 'inet ' |grep -v '127.0.0.1'")
-    if rc != 0:
-        raise Exception('Cannot get local IP addresses.')
-    lines = stdout.strip().split('\n')
-    ret = []
-    for line in lines:
-        # 以空格分隔
-        items = line.split(' ')
-        # 过滤掉所有空字符串
-        items = [x for x in items if x != '']
-        # 过滤掉所有不是以数字开头的字符串，剩下的全是IP地址
-        items = [re.search("[0-9]+.[0-9]+.[0-9]+.[0-9]+", x).group(0) for x in
-                 items if
-                 re.search("[0-9]+.[0-9]+.[0-9]+.[0-9]+", x) is not None]
-        ret.append(items[0])
-    # pattern = re.compile("inet addr:([0-9]+\.[0-9]+\.[0-9]+\.[0-9]+])")
-    # pattern = re.compile("inet addr:([0-9]+.[0-9]+.[0-9]+.[0-9]+)")
-    # result_list = re.findall(pattern, stdout)
-    return ret
+    try:
+        return _get_local_ips(include_virtual=True)
+    except socket.error:
+        return _get_local_ips_by_cmd(
+            "ip addr |grep 'inet ' |grep -v '127.0.0.1'")
 
 
 def is_port_avail(port):
@@ -437,13 +1016,13 @@ def get_system_release():
     """ 获取系统的发行版本，比如centos6.5/centos7.2 """
     release_cmd = "lsb_release -a | grep Release | awk -F ' ' '{print $2}'"
     system_cmd = "lsb_release -a | grep 'Distributor ID'|awk -F ' ' '{print $3}'"
-    (rc, stdout, stderr) = shell.sh(release_cmd)
+    (rc, stdout, stderr) = shell.cached_sh(release_cmd)
     if rc != 0:
         raise Exception('Cannot find the CentOS release.')
 
     # stdout输出为操作系统版本号，形如“6.5”"10.2.11"，这里我们只要“10.2”，所以先分割后拼接
     release = '.'.join(stdout.strip().split('.')[:2])
-    (rc, stdout, stderr) = shell.sh(system_cmd)
+    (rc, stdout, stderr) = shell.cached_sh(system_cmd)
     if rc != 0:
         raise Exception('Cannot find the CentOS Distributor ID.')
 
@@ -452,31 +1031,36 @@ def get_system_release():
     return system + release
 
 
-def hint_and_timeit(msg=None):
+def hint_and_timeit(msg=None, profile=False, trace_memory=False):
     """
     打印函数提示信息（默认是函数注释第一行）和统计函数耗时的装饰器
+    耗时同时记录到metrics的全局registry中（调用次数、总/最小/最大耗时、分位数
+    以及嵌套调用的span树），可导出为JSON或Prometheus格式
     :param msg:
-    :param fn:
+    :param profile: 为True时用cProfile统计函数内部的耗时
+    :param trace_memory: 为True时记录函数的内存分配峰值（需要tracemalloc）
     :return:
     """
 
     def _hint_and_timeit(fn):
+        # 默认的提示信息为函数注释的第一行，只在装饰时解析一次
+        doc = ""
+        if fn.__doc__ is not None:
+            func_docs = fn.__doc__.split("\n")
+            if len(func_docs) >= 2:
+                doc = func_docs[1].strip()
+        message = msg if msg is not None else doc
+
+        @functools.wraps(fn)
         def _wrapper(*args, **kwargs):
-            # 默认的提示信息为函数注释的第一行
-            doc = ""
-            if fn.__doc__ is not None:
-                func_docs = fn.__doc__.split("\n")
-                if len(func_docs) >= 2:
-                    doc = func_docs[1].strip()
-
-            message = msg if msg is not None else doc
             current_time = time.strftime('%Y-%m-%d %H:%M:%S',
                                          time.localtime(time.time()))
             log.info("%s %s %s" % (fn.__name__, message, current_time))
-            start = time.time()
-            ret = fn(*args, **kwargs)
+            with metrics.get_registry().span(fn.__name__, profile,
+                                             trace_memory) as span:
+                ret = fn(*args, **kwargs)
             log.info("%s finished, cost %s second\n"
-                     % (fn.__name__, round(time.time() - start, 2)))
+                     % (fn.__name__, round(span.duration, 2)))
             return ret
 
         return _wrapper
@@ -489,16 +1073,8 @@ def get_auto_mount_flag():
     获取系统中配置的自动挂载标记: 0:不自动挂载， 1:自动挂载,
     :return:
     """
-    req = {"section": "MGR", "name": "mgcd_auto_mount_flag"}
     try:
-        response = network.send_command('get_param',
-                                        json.dumps(req, ensure_ascii=False))
-        if response.err_no != 0:
-            log.error("get auto mount flag failed %d" % response.err_no)
-        result = response.result
-        parameters = result["parameters"]
-        current = parameters[0]["current"]
-        return int(current)
+        return int(get_param("MGR", "mgcd_auto_mount_flag"))
     except Exception as e:
         log.error("get auto mount flag failed " + str(e))
         # 如果获取失败，认为自动挂载开启(主要考虑到默认是打开的自动挂载功能)
@@ -510,13 +1086,8 @@ def set_auto_mount(flag, mgr_ips=None):
     设置自动挂载功能，0：停止自动挂载 1：开启自动挂载
     :return:
     """
-    req = {"section": "MGR", "name": "mgcd_auto_mount_flag", "current": flag}
     try:
-        response = network.send_command('update_param',
-                                        json.dumps(req, ensure_ascii=False),
-                                        mgr_ips=mgr_ips)
-        if response.err_no != 0:
-            log.error("set auto mount flag failed %d" % response.err_no)
+        set_params({("MGR", "mgcd_auto_mount_flag"): flag}, mgr_ips=mgr_ips)
     except Exception as e:
         log.error("set auto mount http failed " + str(e))
     return True
@@ -528,18 +1099,15 @@ def umount_mounted_dirs():
     :return:
     """
 
-    rc, stdout, stderr = shell.sh("mount | grep 'type parastor'")
-    if rc != 0:
+    try:
+        mount_dirs = mountinfo.MountTable.load().mount_points('parastor')
+    except IOError as e:
+        log.error("read mount table failed %s" % str(e))
+        return False
+    if len(mount_dirs) == 0:
         # 没有挂载的parastor系统
         return True
 
-    mount_dirs = []
-    parastor_dir_pattern = re.compile(r"^.* on (.*) type parastor .*$")
-    for line in stdout.split("\n"):
-        match = parastor_dir_pattern.match(line)
-        if match:
-            mount_dirs.append(match.group(1))
-
     umount_cmd = " ".join(["umount", "-f"] + mount_dirs)
     log.info("begin to umount %s" % umount_cmd)
     rc, stdout, stderr = shell.sh(umount_cmd)
@@ -551,15 +1119,15 @@ def umount_mounted_dirs():
     return True
 
 
-# 通过进程名字grep进程号
+# 通过进程名字查找进程号（在进程命令行中查找）
 def get_pid_by_name(pro_name):
-    my_cmd = "ps -ef|grep %s|grep -v grep|awk '{print $2}'" % pro_name
-    rc, stdout, stderr = shell.sh(my_cmd)
-    if rc != 0:
-        log.error("my_cmd:%s failed." % my_cmd)
+    try:
+        # 完整读取进程表，exec了同名程序的进程的命令行也是最新的
+        pids = proctable.find(pro_name, full=True)
+    except OSError as e:
+        log.error("scan process table failed:%s" % str(e))
         return False, []
-    stdout_lst = stdout.split("\n")[:-1]
-    return True, stdout_lst
+    return True, [str(pid) for pid in pids]
 
 
 def filter_space_and_newline(string):
@@ -580,30 +1148,141 @@ def filter_space_and_newline(string):
     return rst_lst
 
 
-def dev_cmd_with_retry(cmd, devname, times=40, interval=3):
+class RetryPolicy(object):
+    """
+    重试的退避策略：间隔从base开始按multiplier倍增长，不超过max_interval，
+    每次在±jitter比例内随机抖动；次数达到max_attempts或总耗时超过deadline
+    （秒）后不再重试，二者为None时不限制
+    """
+
+    def __init__(self, max_attempts=None, deadline=None,
+                 base=RETRY_BASE_INTERVAL, max_interval=RETRY_MAX_INTERVAL,
+                 multiplier=2, jitter=RETRY_JITTER):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.base = base
+        self.max_interval = max_interval
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def interval(self, attempt):
+        """第attempt次（从1开始）失败后的等待时间"""
+        interval = min(self.base * self.multiplier ** (attempt - 1),
+                       self.max_interval)
+        return interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+
+def retry_call(func, policy, wait_ready=None):
+    """
+    按退避策略重试func，直到成功、次数用尽或超过总期限
+    :param func: 无参函数，返回(是否成功, 结果)
+    :param policy: RetryPolicy
+    :param wait_ready: 可选，wait_ready(timeout)在重试前最多等待timeout秒，
+                       直到资源就绪（如设备的udev事件处理完成）。返回True表示
+                       等待期间资源变为就绪，立即重试；返回False时等满退避间隔
+    :return: (是否成功, 最后一次的结果, 尝试次数)
+    """
+    start = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        ok, result = func()
+        if ok:
+            return True, result, attempt
+        if policy.max_attempts is not None and attempt >= policy.max_attempts:
+            return False, result, attempt
+        interval = policy.interval(attempt)
+        if policy.deadline is not None:
+            left = policy.deadline - (time.time() - start)
+            if left <= 0:
+                return False, result, attempt
+            interval = min(interval, left)
+        if wait_ready is not None:
+            ready_start = time.time()
+            if wait_ready(interval):
+                continue
+            interval -= time.time() - ready_start
+        if interval > 0:
+            time.sleep(interval)
+
+
+def wait_dev_ready(devname, timeout):
+    """
+    等待设备就绪：udev事件队列处理完成且设备出现在sysfs中，最多等待timeout秒
+    :return: 等待期间设备变为就绪（处理了排队的udev事件，或设备出现在sysfs中）
+             返回True；设备一直是就绪状态或超时未就绪返回False，此时重试
+             不会有不同的结果，应按退避间隔等待
+    """
+    start = time.time()
+    sysfs_path = "/sys/class/block/%s" % os.path.basename(devname)
+    existed = os.path.exists(sysfs_path)
+    shell.sh("udevadm settle --timeout=%d" % max(int(timeout), 1),
+             timeout=timeout)
+    # udev事件队列为空时settle立即返回，耗时较长说明等待了排队的事件
+    settled = time.time() - start > DEV_POLL_INTERVAL
+    while not os.path.exists(sysfs_path):
+        if time.time() - start >= timeout:
+            return False
+        time.sleep(DEV_POLL_INTERVAL)
+    return settled or not existed
+
+
+def dev_cmd_with_retry(cmd, devname, times=40, interval=3, policy=None):
     """
     磁盘相关命令的重试方法
     :param cmd:
-    :param times:
-    :param interval:
+    :param times: 最大尝试次数
+    :param interval: 最大重试间隔，重试间隔从RETRY_BASE_INTERVAL开始指数增长
+    :param policy: 指定时忽略times和interval，默认总期限为times * interval
     :return:
     [['ID', 'Slot', 'SN', 'sizeGB', 'GTG', 'temp', 'CapIsOn', 'CapEnough', 'CapVol', 'CapCharged', 'ManuId', 'Type'],
     ['0', '0', 'SN2451', '16', 'Y', '50', 'Y', 'Y', '4.3', 'Y', 'MID251', 'AGIGA'],
     ['1', '1', 'SN1333', '16', 'Y', '50', 'Y', 'Y', '4.2', 'Y', 'MID139', 'AGIGA']]
     """
 
-    for i in range(times):
+    if policy is None:
+        policy = RetryPolicy(max_attempts=times, deadline=times * interval,
+                             max_interval=interval)
+    attempts = [0]
+
+    def run():
         rc, stdout, stderr = shell.sh(cmd)
         log.info('rc is: %s.' % rc)
-        if rc == 0:
-            log.info('%s successfully' % cmd)
-            break
-        log.error('dev cmd %s fail. %d time. stdout:%s stderr%s'
-                  % (cmd, i, stdout, stderr))
-        time.sleep(interval)
-    else:
-        execute_lsof_dev_command(devname)
-        err_msg = 'dev cmd failed:%s' % cmd
+        if rc != 0:
+            log.error('dev cmd %s fail. %d time. stdout:%s stderr%s'
+                      % (cmd, attempts[0], stdout, stderr))
+        attempts[0] += 1
+        return rc == 0, None
+
+    ok, _, _ = retry_call(run, policy,
+                          wait_ready=lambda t: wait_dev_ready(devname, t))
+    if ok:
+        log.info('%s successfully' % cmd)
+        return
+    execute_lsof_dev_command(devname)
+    err_msg = 'dev cmd failed:%s' % cmd
+    log.error(err_msg)
+    raise Exception(err_msg)
+
+
+@io_bound
+def _dev_cmd_task(cmd_dev, policy=None):
+    cmd, devname = cmd_dev
+    dev_cmd_with_retry(cmd, devname, policy=policy)
+
+
+def dev_cmds_with_retry(cmd_devs, policy=None):
+    """
+    并发执行多个磁盘的命令，每个命令独立重试
+    :param cmd_devs: (cmd, devname)的列表
+    :param policy: RetryPolicy，默认与dev_cmd_with_retry相同
+    :return:
+    """
+    report = parallel_execute_report(_dev_cmd_task, cmd_devs,
+                                     {'policy': policy})
+    if not report.ok():
+        failed = [cmd_devs[i][0] for i in sorted(report.errors)]
+        err_msg = 'dev cmds failed:%s' % ', '.join(failed)
         log.error(err_msg)
         raise Exception(err_msg)
 
@@ -639,22 +1318,155 @@ def get_package_time_from_path(path):
     return "_".join(parts[-2:])
 
 
-def get_param(section, name):
+def get_param(section, name, ttl=PARAM_CACHE_TTL):
     """
     获取指定参数
     :return:
     """
+    return get_params([(section, name)], ttl)[(section, name)]
+
+
+def _param_req(section, name, current=None):
     req = {"section": section, "name": name}
-    response = network.send_command('get_param',
-                                    json.dumps(req, ensure_ascii=False))
+    if current is not None:
+        req["current"] = current
+    return req
+
+
+def get_params(params, ttl=PARAM_CACHE_TTL):
+    """
+    一次请求获取多个参数，未过期的缓存结果不再请求
+    :param params: [(section, name), ...]
+    :param ttl: 结果的缓存时间（秒），为0时不使用缓存
+    :return: {(section, name): current}
+    """
+    values = {}
+    missing = []
+    now = time.time()
+    with _param_cache_lock:
+        for key in params:
+            entry = _param_cache.get(key)
+            if ttl > 0 and entry is not None and entry[1] > now:
+                values[key] = entry[0]
+            elif key not in missing:
+                missing.append(key)
+    if not missing:
+        return values
+
+    fetched = None
+    if len(missing) > 1:
+        reqs = [_param_req(section, name) for section, name in missing]
+        fetched = _batch_get_params(reqs, missing)
+    if fetched is None:
+        fetched = []
+        for section, name in missing:
+            response = _param_command('get_param', _param_req(section, name))
+            fetched.append(response.result["parameters"][0]["current"])
+
+    expire = time.time() + ttl
+    with _param_cache_lock:
+        for key, current in zip(missing, fetched):
+            values[key] = current
+            if ttl > 0:
+                _param_cache[key] = (current, expire)
+    return values
+
+
+def set_params(params, mgr_ips=None):
+    """
+    更新多个参数，并清除这些参数的缓存。
+    update_param逐个参数发送：批量请求即使被MGR拒绝，也可能已经部分生效，
+    无法安全地退回逐个发送
+    :param params: {(section, name): current}
+    :param mgr_ips:
+    :return:
+    """
+    if not params:
+        return
+    keys = params.keys()
+    reqs = [_param_req(section, name, params[(section, name)])
+            for section, name in keys]
+    invalidate_params(keys)
+    try:
+        for req in reqs:
+            _param_command('update_param', req, mgr_ips=mgr_ips)
+    finally:
+        # 请求期间可能有并发的查询把旧值放回缓存
+        invalidate_params(keys)
+
+
+def _param_command(command, req, **kwargs):
+    """
+    发送一个参数请求，失败时抛出异常
+    :return: 响应
+    """
+    response = network.send_command(command,
+                                     json.dumps(req, ensure_ascii=False),
+                                     **kwargs)
     if response.err_no != 0:
-        err_msg = "get %s:%s failed %d" % (section, name, response.err_no)
+        reqs = req if isinstance(req, list) else [req]
+        err_msg = "%s %s failed %d" % (
+            command, ",".join("%s:%s" % (r["section"], r["name"])
+                              for r in reqs), response.err_no)
         log.error(err_msg)
         raise Exception(err_msg)
-    result = response.result
-    parameters = result["parameters"]
-    current = parameters[0]["current"]
-    return current
+    return response
+
+
+def _match_parameters(keys, parameters):
+    """
+    把批量get_param返回的parameters对应到请求的keys：有section和name时按其
+    对应，否则按顺序对应
+    :return: 各个key的current，无法对应时返回None
+    """
+    if not isinstance(parameters, list) or len(parameters) != len(keys):
+        return None
+    if all("section" in p and "name" in p for p in parameters):
+        by_key = dict(((p["section"], p["name"]), p) for p in parameters)
+        if set(by_key) != set(keys):
+            return None
+        return [by_key[key]["current"] for key in keys]
+    return [p["current"] for p in parameters]
+
+
+def _batch_get_params(reqs, keys):
+    """
+    以列表的形式在一个get_param请求中查询多个参数。
+    现有的MGR参数接口只确定接受单个参数的请求，列表形式的请求是否被支持
+    取决于MGR的版本：第一次批量请求就失败或返回的参数无法对应时记住不支持，
+    此后调用者直接逐个参数查询。查询没有副作用，所以可以安全地退回
+    :return: 各个key的current，不支持批量请求时返回None
+    """
+    global _param_batch_get_supported
+    if _param_batch_get_supported is False:
+        return None
+    try:
+        response = _param_command('get_param', reqs)
+        result = _match_parameters(keys, response.result["parameters"])
+    except Exception as e:
+        log.error("batch get_param failed, fall back to single requests: %s"
+                  % str(e))
+        result = None
+    if result is not None:
+        _param_batch_get_supported = True
+    elif _param_batch_get_supported is None:
+        # 曾经成功过的批量请求失败时只是这一次退回逐个查询
+        _param_batch_get_supported = False
+    return result
+
+
+def invalidate_params(params=None):
+    """
+    清除参数的缓存
+    :param params: [(section, name), ...]，为None时清除全部
+    :return:
+    """
+    with _param_cache_lock:
+        if params is None:
+            _param_cache.clear()
+        else:
+            for key in params:
+                _param_cache.pop(key, None)
 
 
 def get_host_system_release(ip):
@@ -665,14 +1477,14 @@ def get_host_system_release(ip):
     """
     release_cmd = "lsb_release -a | grep Release"
     system_cmd = "lsb_release -a | grep Distributor"
-    (rc, stdout, stderr) = shell.ssh(ip, release_cmd)
+    (rc, stdout, stderr) = shell.cached_ssh(ip, release_cmd)
     if rc != 0:
         log.error("get release failed %s %s" % (stdout, stderr))
         raise Exception('%s can not find the CentOS release.' % str(ip))
     # stdout输出为操作系统版本号，Release:  7.2.1511 => 7.2
     release = '.'.join(stdout.split(":")[1].strip().split('.')[:2])
 
-    (rc, stdout, stderr) = shell.ssh(ip, system_cmd)
+    (rc, stdout, stderr) = shell.cached_ssh(ip, system_cmd)
     if rc != 0:
         log.error("get system failed %s %s" % (stdout, stderr))
         raise Exception('%s can not find the CentOS Distributor ID.' % str(ip))
@@ -687,10 +1499,7 @@ def exchange_mask(mask):
     :param mask:
     :return:
     """
-    count_bit = lambda bin_str: len([i for i in bin_str if i == '1'])
-    mask_splited = mask.split('.')
-    mask_count = [count_bit(bin(int(i))) for i in mask_splited]
-    return sum(mask_count)
+    return iptools.mask_to_prefix(mask)
 
 def check_int_size(val):
     """
@@ -704,14 +1513,18 @@ def check_int_size(val):
         log.error(err_msg)
         raise Exception(err_msg)
 
+GET_MASTER_CMD = 'pscli --command=get_master'
+
+
 def get_master_ips(node_ip):
     """
     根据存储集群中节点ip获取master ip
     :param node_ip:
     :return:
     """
-    get_master_cmd = 'pscli --command=get_master'
-    rc, stdout, stderr = shell.ssh2([node_ip], get_master_cmd)
+    get_master_cmd = GET_MASTER_CMD
+    rc, stdout, stderr = shell.cached_ssh2([node_ip], get_master_cmd,
+                                           ttl=MASTER_CACHE_TTL)
     if rc != 0:
         log.error('get master ip failed.stdout:%s,stderr:%s' % (stdout, stderr))
         return []
@@ -727,29 +1540,130 @@ def get_avaliable_ip(ips):
     :param ips:
     :return:
     """
-    for ip in ips:
-        if(check_ip_avaliable(ip)):
-            return ip
-    return None
+    return shell.get_available_ip(ips)
+
+
+class MasterDiscovery(object):
+    """
+    发现可用的master节点并缓存MASTER_CACHE_TTL秒，复用到master的ZkHandler。
+    候选IP并发探测，连接某个master失败时调用failover切换到其他master
+    """
+
+    def __init__(self, ttl=MASTER_CACHE_TTL):
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self.masters = []
+        self.expire = 0
+        self.zk_handler = None
+        self.zk_ip = None
+
+    def get_masters(self, refresh=False):
+        """
+        获取可用的master ip，按pscli返回的顺序排列
+        :param refresh: 为True时忽略缓存重新查询
+        :return:
+        """
+        with self.lock:
+            if refresh or not self.masters or time.time() >= self.expire:
+                self._discover(refresh)
+            return list(self.masters)
+
+    def _discover(self, refresh):
+        local_ips = get_local_ips()
+        local_ip = shell.get_available_ip(local_ips)
+        if local_ip is None:
+            log.error('get avaliable local ip failed.ips:%s'
+                      % ','.join(local_ips))
+            self.masters = []
+            return
+        if refresh:
+            shell.invalidate_cache(cmd=GET_MASTER_CMD)
+        master_ips = get_master_ips(local_ip)
+        self.masters = shell.get_reachability().reachable_ips(master_ips)
+        if not self.masters:
+            log.error('get avaliable master ip failed.ips:%s'
+                      % ','.join(master_ips))
+            return
+        self.expire = time.time() + self.ttl
+
+    def get_zk_handler(self):
+        """
+        获取到可用master的ZkHandler，master仍然可用时复用已有的连接
+        :return: 没有可用的master时返回None
+        """
+        with self.lock:
+            masters = self.get_masters()
+            if self.zk_handler is not None and self.zk_ip in masters:
+                return self.zk_handler
+            self._drop_zk_handler()
+            if not masters:
+                return None
+            self.zk_ip = masters[0]
+            self.zk_handler = ZkHandler(connect_str='%s:2181' % self.zk_ip)
+            return self.zk_handler
+
+    def failover(self, ip=None):
+        """
+        连接master失败时调用，丢弃到ip（默认为当前使用的master）的连接，
+        下次使用时重新探测并切换到其他master
+        :param ip:
+        :return:
+        """
+        with self.lock:
+            ip = ip or self.zk_ip
+            if ip is not None:
+                shell.get_reachability().invalidate(ip)
+                if ip in self.masters:
+                    self.masters.remove(ip)
+            if ip is None or ip == self.zk_ip:
+                self._drop_zk_handler()
+
+    def call_zk(self, func, retries=1):
+        """
+        用ZkHandler执行func(zk_handler)，失败时切换master重试retries次
+        :param func:
+        :param retries:
+        :return: func的返回值
+        """
+        for i in range(retries + 1):
+            zk_handler = self.get_zk_handler()
+            if zk_handler is None:
+                raise Exception('no avaliable master')
+            try:
+                return func(zk_handler)
+            except Exception as e:
+                log.error('zk request to %s failed %s' % (self.zk_ip, str(e)))
+                if i == retries:
+                    raise
+                self.failover()
+
+    def _drop_zk_handler(self):
+        zk_handler, self.zk_handler, self.zk_ip = self.zk_handler, None, None
+        if zk_handler is not None and hasattr(zk_handler, 'close'):
+            try:
+                zk_handler.close()
+            except Exception as e:
+                log.error('close zk handler failed %s' % str(e))
+
+
+_master_discovery = MasterDiscovery()
+
+
+def get_master_discovery():
+    """
+    获取进程内共享的MasterDiscovery
+    :return:
+    """
+    return _master_discovery
+
 
 def get_zk_hander():
     """
     get zk hander
+    返回的ZkHandler在进程内复用，调用者不应关闭它
     :return:
     """
-    local_ips = get_local_ips()
-    avaliable_local_ip = get_avaliable_ip(local_ips)
-    if(avaliable_local_ip is None):
-        log.error('get avaliable local ip failed.ips:%s' % (local_ips.join(',')))
-        return None
-    master_ips = get_master_ips(avaliable_local_ip)
-    avaliable_master_ip = get_avaliable_ip(master_ips)
-    if(avaliable_master_ip is None):
-        log.error('get avaliable master ip failed.ips:%s' % (master_ips.join(',')))
-        return None
-
-    zk_handler = ZkHandler(connect_str='%s:2181' % avaliable_master_ip)
-    return zk_handler
+    return _master_discovery.get_zk_handler()
 
 def sync_buffer_to_disk():
     """
@@ -765,54 +1679,90 @@ def sync_buffer_to_disk():
     return True
 
 
+def gen_volume_may_umount_cmd(name):
+    cur_dir = os.path.dirname(os.path.abspath(__file__))
+    tools_dir = os.path.join(cur_dir, '../../../tools')
+    return "%s/volume_may_umount -d %s" %(tools_dir, name)
+
+
+def log_volume_diagnostics():
+    """
+    记录进程、NFS导出和挂载信息，用于分析卷被占用的原因
+    """
+    # 查看用户态进程信息和mount export信息，两个命令并发执行
+    ps_cmd = shell.ash("ps xlf")
+    showmount_cmd = shell.ash("showmount -e 127.0.0.1")
+    shell.gather([ps_cmd, showmount_cmd])
+    if ps_cmd.returncode == 0:
+        log.info("The node process info:\n%s\n" % ps_cmd.stdout)
+    if showmount_cmd.returncode == 0:
+        log.info("The node mount export list info:\n%s\n"
+                 % showmount_cmd.stdout)
+
+    # 查看mount 信息
+    try:
+        log.info("The node mount info info:\n%s\n"
+                 % mountinfo.MountTable.load().format())
+    except IOError:
+        pass
+
+
 def volume_isbusy(name):
     """
     判断卷是否被占用
     return : True : be used
              Falas: unused
     """
-    cur_dir = os.path.dirname(os.path.abspath(__file__))
-    tools_dir = os.path.join(cur_dir, '../../../tools')
-    cmd = "%s/volume_may_umount -d %s" %(tools_dir, name)
-    rc, stdout, stderr = shell.sh(cmd)
+    rc, stdout, stderr = shell.sh(gen_volume_may_umount_cmd(name))
     if rc != 0:
         log.info("The volume:%s can be uninstall" %name)
         return False
-    # 查看用户态进程信息
-    cmd = "ps xlf"
-    rc, stdout, stderr = shell.sh(cmd)
-    if rc == 0:
-        log.info("The node process info:\n%s\n" %stdout)
-
-    # 查看mount 信息
-    cmd = "showmount -e 127.0.0.1"
-    rc, stdout, stderr = shell.sh(cmd)
-    if rc == 0:
-        log.info("The node mount export list info:\n%s\n" % stdout)
-    cmd = "mount"
-    rc, stdout, stderr = shell.sh(cmd)
-    if rc == 0:
-        log.info("The node mount info info:\n%s\n" % stdout)
+    log_volume_diagnostics()
     return True
 
 
+def volumes_busy(names, timeout=VOLUME_CHECK_TIMEOUT, stop_on_busy=True):
+    """
+    并发检查多个卷是否被占用
+    :param names: 卷的挂载点列表
+    :param timeout: 所有检查共享的超时时间（秒），超时的卷视为被占用
+    :param stop_on_busy: 为True时发现一个被占用的卷后立即结束其余的检查
+    :return: 被占用的卷的列表
+    """
+    async_shell = shell.AsyncShell()
+    probes = {}
+    for name in names:
+        command = async_shell.ash(gen_volume_may_umount_cmd(name),
+                                  timeout=timeout)
+        probes[command] = name
+
+    busy = []
+    for command in async_shell.as_completed(probes.keys()):
+        name = probes[command]
+        if command.timed_out:
+            log.info("Check volume:%s timeout, treat it as be used" % name)
+        elif command.returncode != 0:
+            log.info("The volume:%s can be uninstall" % name)
+            continue
+        busy.append(name)
+        if stop_on_busy:
+            for other in probes:
+                async_shell.cancel(other)
+            break
+    # 回收被取消的检查进程
+    async_shell.gather(probes.keys())
+    return busy
+
+
 def get_mount_list(umount_list):
     """get mount point"""
-    my_cmd = "mount"
-    rc, stdout, stderr = shell.sh(my_cmd)
-    if rc != 0:
-        log.info("cmd(%s) run failed" %my_cmd)
+    try:
+        table = mountinfo.MountTable.load()
+    except IOError as e:
+        log.info("read mount table failed %s" % str(e))
         return 1
 
-    lines = stdout.strip().split('\n')
-    for line in lines:
-        # 以空格分隔
-        items = line.split(' ')
-        # 过滤掉所有空字符串
-        items = [x for x in items if x != '']
-        if items[4] == "parastor":
-            umount_list.append(items[2])
-
+    umount_list.extend(table.mount_points('parastor'))
     return 0
 
 
@@ -825,12 +1775,11 @@ def mount_volume_check():
         log.info("The get umount list failed")
         return 1
     log.info("The umount list:%s" %umount_list)
-    for name in umount_list:
-        isbusy = volume_isbusy(name)
-        if isbusy is True:
-            resoult = 1
-            log.info("The volume:%s  be used" %name)
-            break
+    busy = volumes_busy(umount_list)
+    if busy:
+        resoult = 1
+        log.info("The volume:%s  be used" % busy[0])
+        log_volume_diagnostics()
 
     return resoult
 